@@ -0,0 +1,222 @@
+#
+# AnchorIndex: uniform grid spatial index over poly-affine anchor positions
+#
+# Anchors are stored by position in the anchor list of PolyAffineCL and
+# binned into cubic cells of cellSize. Supports nearest, radius, and
+# k-nearest queries, with incremental insert, remove, and move so that the
+# index can be kept alongside the anchor list.
+#
+# Cells hold anchor ids, which increase with insertion order and do not
+# change when earlier anchors are removed. The ids of the anchors in list
+# order stay sorted, so the list index of an id is found by bisection and
+# removing an anchor does not relabel any cell. Bounds of the occupied cells
+# grow on insert and move and are not shrunk on removal, so they may be
+# loose but always contain every anchor.
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+import bisect
+import math
+
+import numpy
+
+class AnchorIndex:
+
+  def __init__(self, cellSize=1.0):
+
+    self.cellSize = float(cellSize)
+
+    # Anchor positions, with anchor index as position in the list
+    self.points = []
+
+    # Anchor ids in list order, sorted
+    self.ids = []
+    self.nextId = 0
+
+    # Anchor ids in each occupied cell, with cell coordinates as key
+    self.cells = { }
+
+    # Lower and upper cell coordinates containing all anchors
+    self.cellMin = None
+    self.cellMax = None
+
+  def rebuild(self, points, cellSize=None):
+    """Replace all anchors"""
+    if cellSize is not None and cellSize > 0.0:
+      self.cellSize = float(cellSize)
+    self.points = []
+    self.ids = []
+    self.cells = { }
+    self.cellMin = None
+    self.cellMax = None
+    for p in points:
+      self.insert(p)
+
+  def insert(self, p):
+    """Append anchor, returns its index"""
+    i = len(self.points)
+    self.points.append(numpy.array(p, dtype=numpy.float64).ravel())
+    self.ids.append(self.nextId)
+    self.nextId += 1
+    self._link(self.ids[i], self._get_cell(self.points[i]))
+    return i
+
+  def remove(self, i):
+    """Remove anchor i, anchors after it shift down by one as in a list"""
+    self._unlink(i)
+    del self.points[i]
+    del self.ids[i]
+    if len(self.points) == 0:
+      self.cellMin = None
+      self.cellMax = None
+
+  def move(self, i, p):
+    """Update position of anchor i"""
+    p = numpy.array(p, dtype=numpy.float64).ravel()
+    oldCell = self._get_cell(self.points[i])
+    newCell = self._get_cell(p)
+    self.points[i] = p
+    if oldCell != newCell:
+      self._unlink(i, oldCell)
+      self._link(self.ids[i], newCell)
+
+  def nearest(self, p, maxDist=float('Inf')):
+    """Returns index and distance of the anchor closest to p within maxDist,
+    or None and infinity"""
+    found = self.knn(p, 1, maxDist)
+    if len(found) == 0:
+      return None, float('Inf')
+    return found[0]
+
+  def knn(self, p, k, maxDist=float('Inf')):
+    """Returns list of (index, distance) of the k anchors closest to p
+    within maxDist, sorted by distance"""
+
+    p = numpy.array(p, dtype=numpy.float64).ravel()
+
+    if k <= 0 or len(self.points) == 0:
+      return []
+
+    center = self._get_cell(p)
+    maxRing = self._max_ring(center)
+
+    candidates = []
+    ring = 0
+    while ring <= maxRing:
+      # Scanning the cells of a large ring costs more than checking all
+      # anchors
+      if (2*ring+1)**3 > 8*len(self.points):
+        return self._brute_force(p, k, maxDist)
+
+      for cell in self._ring_cells(center, ring):
+        for i in self._get_indices(self.cells.get(cell, [])):
+          d = numpy.linalg.norm(self.points[i] - p)
+          if d <= maxDist:
+            candidates.append((i, d))
+
+      # Anchors in rings further out are at least ring*cellSize away
+      reach = ring * self.cellSize
+      if reach >= maxDist:
+        break
+      if len(candidates) >= k:
+        candidates.sort(key=lambda c: c[1])
+        if candidates[k-1][1] <= reach:
+          break
+
+      ring += 1
+
+    candidates.sort(key=lambda c: c[1])
+    return candidates[:k]
+
+  def radius(self, p, dist):
+    """Returns list of (index, distance) of anchors within dist of p,
+    sorted by distance"""
+
+    p = numpy.array(p, dtype=numpy.float64).ravel()
+
+    lo = self._get_cell(p - dist)
+    hi = self._get_cell(p + dist)
+
+    numCells = 1
+    for d in range(3):
+      numCells *= hi[d] - lo[d] + 1
+
+    found = []
+    if numCells > len(self.cells):
+      for key in self.cells:
+        if all([lo[d] <= key[d] <= hi[d] for d in range(3)]):
+          found += self.cells[key]
+    else:
+      for cx in xrange(lo[0], hi[0]+1):
+        for cy in xrange(lo[1], hi[1]+1):
+          for cz in xrange(lo[2], hi[2]+1):
+            found += self.cells.get((cx, cy, cz), [])
+
+    result = []
+    for i in self._get_indices(found):
+      d = numpy.linalg.norm(self.points[i] - p)
+      if d <= dist:
+        result.append((i, d))
+
+    result.sort(key=lambda c: c[1])
+    return result
+
+  def _get_cell(self, p):
+    return (int(math.floor(p[0] / self.cellSize)),
+      int(math.floor(p[1] / self.cellSize)),
+      int(math.floor(p[2] / self.cellSize)))
+
+  def _get_indices(self, ids):
+    """List indices of anchor ids"""
+    return [bisect.bisect_left(self.ids, j) for j in ids]
+
+  def _link(self, j, cell):
+    self.cells.setdefault(cell, []).append(j)
+    if self.cellMin is None:
+      self.cellMin = list(cell)
+      self.cellMax = list(cell)
+      return
+    for d in range(3):
+      self.cellMin[d] = min(self.cellMin[d], cell[d])
+      self.cellMax[d] = max(self.cellMax[d], cell[d])
+
+  def _unlink(self, i, cell=None):
+    if cell is None:
+      cell = self._get_cell(self.points[i])
+    members = self.cells[cell]
+    members.remove(self.ids[i])
+    if len(members) == 0:
+      del self.cells[cell]
+
+  def _max_ring(self, center):
+    """Ring beyond which there are no occupied cells"""
+    maxRing = 0
+    for d in range(3):
+      maxRing = max(maxRing, abs(self.cellMin[d] - center[d]),
+        abs(self.cellMax[d] - center[d]))
+    return maxRing
+
+  def _ring_cells(self, center, ring):
+    """Cells at Chebyshev distance ring from center"""
+    if ring == 0:
+      return [center]
+    cells = []
+    for dx in xrange(-ring, ring+1):
+      for dy in xrange(-ring, ring+1):
+        if abs(dx) == ring or abs(dy) == ring:
+          dzs = xrange(-ring, ring+1)
+        else:
+          dzs = (-ring, ring)
+        for dz in dzs:
+          cells.append((center[0]+dx, center[1]+dy, center[2]+dz))
+    return cells
+
+  def _brute_force(self, p, k, maxDist):
+    candidates = []
+    for i in range(len(self.points)):
+      d = numpy.linalg.norm(self.points[i] - p)
+      if d <= maxDist:
+        candidates.append((i, d))
+    candidates.sort(key=lambda c: c[1])
+    return candidates[:k]
@@ -7,23 +7,116 @@
 #
 # Warping is applied as Iwarped = I(h)
 #
+# A map can instead be stored as one interleaved (x, y, z, pad) float4
+# buffer (interleaved=True), which keeps the components of a voxel in one
+# 16 byte load for the vector operations of the fluid update. Both layouts
+# share the same methods, to_interleaved / to_planar convert between them.
+# Vector fields that are not maps (gradients, momenta, velocities) use the
+# same class, see gradient_field.
+#
+# With displacement=True a map is stored as u(p) = h(p) - p, the kernels add
+# the grid position on the fly. The identity is then a zero field and a
+# velocity field can be used as a small deformation without adding it to an
+# identity copy. to_displacement / to_absolute convert between the two.
+#
 # Requires: ImageCL
 #
 # Author: Marcel Prastawa (marcel.prastawa@gmail.com)
 #
 
 import ImageCL
+from ImageExpressionCL import ImageExpressionCL
+
+import pyopencl.array as cla
+from pyopencl.elementwise import ElementwiseKernel
+from pyopencl.reduction import ReductionKernel
+
+import math
+import numpy as np
 
 class DeformationCL:
 
-  def __init__(self, imgcl, hlist=None):
+  # Identity mappings shared through get_identity, with device, grid, and
+  # storage as key
+  identityCache = { }
+
+  @staticmethod
+  def get_identity(imgcl, interleaved=False, displacement=False):
+    """Returns identity mapping on the grid of imgcl, shared between callers
+    and not to be modified"""
+    key = (id(imgcl.cldevice), tuple(imgcl.shape), tuple(imgcl.spacing),
+      imgcl.storage, interleaved, displacement)
+    if not DeformationCL.identityCache.has_key(key):
+      if interleaved:
+        identity = DeformationCL.empty_like(imgcl, interleaved=True)
+      else:
+        hlist = []
+        for dim in xrange(3):
+          h = imgcl.clone_empty()
+          h.clarray = cla.empty(imgcl.clqueue, tuple(imgcl.shape),
+            imgcl.storage_dtype())
+          hlist.append(h)
+        identity = DeformationCL(hlist[0], hlist)
+      identity.displacement = displacement
+      identity.set_identity()
+      DeformationCL.identityCache[key] = identity
+    return DeformationCL.identityCache[key]
+
+  @staticmethod
+  def clear_identity_cache():
+    DeformationCL.identityCache = { }
+
+  @staticmethod
+  def empty_like(imgcl, interleaved=False, displacement=False):
+    """Returns field on the grid of imgcl with uninitialized values"""
+    if interleaved:
+      if imgcl.storage != "float":
+        raise ValueError("Interleaved fields require float storage, got " +
+          str(imgcl.storage))
+      clh = cla.empty(imgcl.clqueue, tuple(imgcl.shape), cla.vec.float4,
+        allocator=imgcl.cldevice.allocator)
+      return DeformationCL(imgcl, clh=clh, displacement=displacement)
 
+    hlist = []
+    for dim in xrange(3):
+      h = imgcl.clone_empty()
+      h.clarray = cla.empty(imgcl.clqueue, tuple(imgcl.shape),
+        imgcl.storage_dtype(), allocator=imgcl.cldevice.allocator)
+      hlist.append(h)
+    return DeformationCL(hlist[0], hlist, displacement=displacement)
+
+  @staticmethod
+  def gradient_field(imgcl, interleaved=False):
+    """Returns forward difference gradient of imgcl as a vector field"""
+    if not interleaved:
+      return DeformationCL(imgcl, imgcl.gradient())
+
+    outdef = DeformationCL.empty_like(imgcl, interleaved=True)
+    imgcl.clprogram.gradient_forward4(imgcl.clqueue, imgcl.shape, None,
+      imgcl.clsize.data, imgcl.clarray.data, imgcl.clspacing.data,
+      outdef.clh.data).wait()
+    return outdef
+
+  def __init__(self, imgcl, hlist=None, clh=None, displacement=False):
+
+    # Grid geometry, clarray of imgcl is not used
     self.clgrid = imgcl
 
+    self.cldevice = imgcl.cldevice
     self.clqueue = imgcl.clqueue
     self.clprogram = imgcl.clprogram
 
-    if hlist is None:
+    # Interleaved float4 storage, hx / hy / hz are None when set
+    self.clh = clh
+
+    # Store displacements h(p) - p instead of absolute coordinates
+    self.displacement = displacement
+
+    if clh is not None:
+      self.hx = None
+      self.hy = None
+      self.hz = None
+    elif hlist is None:
       # Assign identity mapping if mapping not specified at init
       self.hx = imgcl.clone()
       self.hy = imgcl.clone()
@@ -36,48 +129,253 @@ class DeformationCL:
 
   def __del__(self):
     self.clgrid = None
+    self.clh = None
     self.hx = None
     self.hy = None
     self.hz = None
 
+  def is_interleaved(self):
+    return self.clh is not None
+
+  def _get_grid(self):
+    """Returns ImageCL holding the geometry of the field"""
+    if self.is_interleaved():
+      return self.clgrid
+    return self.hx
+
+  def _add_grid_position(self, sign):
+    """Add sign times grid position to all vectors, in place"""
+    grid = self._get_grid()
+    if self.is_interleaved():
+      self.clprogram.add_grid_position4(self.clqueue, grid.shape, None,
+        grid.clsize.data, grid.clspacing.data, np.float32(sign),
+        self.clh.data).wait()
+    else:
+      self.clprogram.add_grid_position(self.clqueue, grid.shape, None,
+        grid.clsize.data, grid.clspacing.data, np.float32(sign),
+        self.hx.clarray.data, self.hy.clarray.data,
+        self.hz.clarray.data).wait()
+
+  def to_displacement(self):
+    """Returns map stored as displacements"""
+    if self.displacement:
+      return self
+    outdef = self.clone()
+    outdef._add_grid_position(-1.0)
+    outdef.displacement = True
+    return outdef
+
+  def to_absolute(self):
+    """Returns map stored as absolute coordinates"""
+    if not self.displacement:
+      return self
+    outdef = self.clone()
+    outdef._add_grid_position(1.0)
+    outdef.displacement = False
+    return outdef
+
+  def _elementwise(self, name, arguments, operation):
+    """Returns memoized elementwise kernel on interleaved fields"""
+    key = ("DeformationCL", name, arguments, operation)
+    def builder():
+      return ElementwiseKernel(self.cldevice.clcontext, arguments, operation,
+        name)
+    return self.cldevice.get_kernel(key, builder)
+
+  def to_interleaved(self):
+    """Returns field stored as interleaved float4 vectors"""
+    if self.is_interleaved():
+      return self
+    outdef = DeformationCL.empty_like(self.hx, interleaved=True,
+      displacement=self.displacement)
+    # Flat launch over all voxels
+    self.clprogram.interleave3(self.clqueue, (self.hx.clarray.size,), None,
+      self.hx.clsize.data,
+      self.hx.clarray.data, self.hy.clarray.data, self.hz.clarray.data,
+      outdef.clh.data).wait()
+    return outdef
+
+  def to_planar(self):
+    """Returns field stored as three ImageCL objects"""
+    if not self.is_interleaved():
+      return self
+    outdef = DeformationCL.empty_like(self.clgrid, interleaved=False,
+      displacement=self.displacement)
+    self.clprogram.deinterleave3(self.clqueue, (self.clh.size,), None,
+      self.clgrid.clsize.data, self.clh.data,
+      outdef.hx.clarray.data, outdef.hy.clarray.data,
+      outdef.hz.clarray.data).wait()
+    return outdef
+
   def clone(self):
+    if self.is_interleaved():
+      return DeformationCL(self.clgrid, clh=self.clh.copy(),
+        displacement=self.displacement)
     hcopies = [self.hx.clone(), self.hy.clone(), self.hz.clone()]
-    return DeformationCL(self.clgrid, hcopies)
+    return DeformationCL(self.clgrid, hcopies, displacement=self.displacement)
 
   def set_mapping(self, hx, hy, hz):
+    self.clh = None
     self.hx = hx
     self.hy = hy
     self.hz = hz
+    self.cldevice = self.hx.cldevice
     self.clqueue = self.hx.clqueue
     self.clprogram = self.hx.clprogram
 
   def set_identity(self):
 
+    if self.displacement:
+      if self.is_interleaved():
+        knl = self._elementwise("zero4", "float4 *h", "h[i] = (float4)(0.0f)")
+        knl(self.clh, queue=self.clqueue)
+      else:
+        self.hx.fill(0.0)
+        self.hy.fill(0.0)
+        self.hz.fill(0.0)
+      return
+
+    if self.is_interleaved():
+      self.clprogram.identityInterleaved(self.clqueue, self.clgrid.shape, None,
+        self.clgrid.clsize.data, self.clgrid.clspacing.data,
+        self.clh.data).wait()
+      return
+
     clspacing = self.hx.clspacing
 
     self.clprogram.identity(self.clqueue, self.hx.shape, None,
+      self.hx.clsize.data,
       clspacing.data,
       self.hx.clarray.data,  self.hy.clarray.data, self.hz.clarray.data).wait()
 
-  def add_velocity(self, velocList):
-    self.hx.add_inplace(velocList[0])
-    self.hy.add_inplace(velocList[1])
-    self.hz.add_inplace(velocList[2])
+  def add_velocity(self, velocity):
+    """Add velocity field, either a DeformationCL or a list of 3 ImageCL"""
+    if isinstance(velocity, DeformationCL):
+      if velocity.is_interleaved() != self.is_interleaved():
+        if self.is_interleaved():
+          velocity = velocity.to_interleaved()
+        else:
+          velocity = velocity.to_planar()
+      if self.is_interleaved():
+        knl = self._elementwise("add_velocity4",
+          "float4 *h, float4 *v", "h[i] += v[i]")
+        knl(self.clh, velocity.clh, queue=self.clqueue)
+        return
+      velocity = [velocity.hx, velocity.hy, velocity.hz]
+    elif self.is_interleaved():
+      names = ["vx", "vy", "vz"]
+      arguments = ["float4 *h"] + [ImageExpressionCL.declaration(
+        velocity[d], names[d]) for d in range(3)]
+      values = [ImageExpressionCL.load(velocity[d], names[d])
+        for d in range(3)]
+      knl = self._elementwise("add_velocity4_planar", ", ".join(arguments),
+        "h[i] += (float4)(%s, %s, %s, 0.0f)" % tuple(values))
+      knl(self.clh, velocity[0].clarray, velocity[1].clarray,
+        velocity[2].clarray, queue=self.clqueue)
+      return
+
+    self.hx.add_inplace(velocity[0])
+    self.hy.add_inplace(velocity[1])
+    self.hz.add_inplace(velocity[2])
+
+  def scale(self, v):
+    """Scale all components in place"""
+    if self.is_interleaved():
+      knl = self._elementwise("scale4", "float4 *h, float s", "h[i] *= s")
+      knl(self.clh, np.float32(v), queue=self.clqueue)
+      return
+    self.hx.scale(v)
+    self.hy.scale(v)
+    self.hz.scale(v)
+
+  def multiply(self, imgcl):
+    """Returns field with all components multiplied by scalar image"""
+    if self.is_interleaved():
+      outdef = DeformationCL.empty_like(self.clgrid, interleaved=True,
+        displacement=self.displacement)
+      knl = self._elementwise("multiply4",
+        "float4 *out, float4 *h, " + ImageExpressionCL.declaration(imgcl, "s"),
+        "out[i] = h[i] * %s" % ImageExpressionCL.load(imgcl, "s"))
+      knl(outdef.clh, self.clh, imgcl.clarray, queue=self.clqueue)
+      return outdef
+    return DeformationCL(self.hx, [self.hx.multiply(imgcl),
+      self.hy.multiply(imgcl), self.hz.multiply(imgcl)],
+      displacement=self.displacement)
+
+  def recursive_gaussian(self, sigma):
+    """Returns field with each component smoothed by recursive Gaussian"""
+    if not self.is_interleaved():
+      return DeformationCL(self.hx, [self.hx.recursive_gaussian(sigma),
+        self.hy.recursive_gaussian(sigma), self.hz.recursive_gaussian(sigma)],
+        displacement=self.displacement)
+
+    outdef = self.clone()
+
+    grid = self.clgrid
+    sizeX, sizeY, sizeZ = grid.shape
+
+    outdef.clprogram.recursive_gaussian4_z(outdef.clqueue, (sizeY, sizeX), None,
+      grid.clsize.data, outdef.clh.data,
+      np.float32(sigma / grid.spacing[2])).wait()
+    outdef.clprogram.recursive_gaussian4_y(outdef.clqueue, (sizeZ, sizeX), None,
+      grid.clsize.data, outdef.clh.data,
+      np.float32(sigma / grid.spacing[1])).wait()
+    outdef.clprogram.recursive_gaussian4_x(outdef.clqueue, (sizeZ, sizeY), None,
+      grid.clsize.data, outdef.clh.data,
+      np.float32(sigma / grid.spacing[0])).wait()
+
+    return outdef
+
+  def add_splat(self, posM, valueM, sigmaM):
+    """Add splatted vectors, see ImageCL.add_splat3"""
+    if not self.is_interleaved():
+      ImageCL.ImageCL.add_splat3([self.hx, self.hy, self.hz],
+        posM, valueM, sigmaM)
+      return
+
+    grid = self.clgrid
+
+    clposM = cla.to_device(self.clqueue, posM)
+    clvalueM = cla.to_device(self.clqueue, valueM)
+    clsigmaM = cla.to_device(self.clqueue, sigmaM)
+
+    self.clprogram.add_splat3Interleaved(self.clqueue, grid.shape, None,
+      grid.clsize.data,
+      clposM.data, clvalueM.data, clsigmaM.data,
+      np.uint32(posM.shape[0]),
+      self.clh.data,
+      grid.clspacing.data).wait()
 
   def maxMagnitude(self):
-    magimg = self.hx.multiply(self.hx)
-    magimg.add_inplace( self.hy.multiply(self.hy) )
-    magimg.add_inplace( self.hz.multiply(self.hz) )
+    if self.is_interleaved():
+      key = ("DeformationCL", "maxMagnitude4")
+      def builder():
+        return ReductionKernel(self.cldevice.clcontext, np.float32,
+          neutral="0.0f", reduce_expr="fmax(a,b)",
+          map_expr="h[i].x*h[i].x + h[i].y*h[i].y + h[i].z*h[i].z",
+          arguments="__global float4 *h")
+      knl = self.cldevice.get_kernel(key, builder)
+      return math.sqrt( knl(self.clh, queue=self.clqueue).get()[()] )
+
+    magimg = self.hx.lazy().square()
+    magimg = magimg.add( self.hy.lazy().square() )
+    magimg = magimg.add( self.hz.lazy().square() )
     return math.sqrt( magimg.max() )
 
   def resample(self, targetShape):
+    if self.is_interleaved():
+      return self.to_planar().resample(targetShape).to_interleaved()
+
+    # Displacements are physical offsets, resampled the same way as
+    # absolute coordinates
+
     hx_new = self.hx.resample(targetShape)
     hy_new = self.hy.resample(targetShape)
     hz_new = self.hz.resample(targetShape)
 
     H_new = [hx_new, hy_new, hz_new]
 
-    outdef = DeformationCL(hx_new, H_new)
+    outdef = DeformationCL(hx_new, H_new, displacement=self.displacement)
 
     H_new = None
 
@@ -85,24 +383,85 @@ class DeformationCL:
 
   def applyTo(self, vol):
     # Output image is in the same grid as h
-    outimgcl = self.hx.clone()
+    grid = self._get_grid()
+
+    # Kernels read all images with the storage type of the map
+    if vol.storage != grid.storage:
+      vol = vol.to_storage(grid.storage)
+
+    outimgcl = grid.clone_empty()
+    outimgcl.clarray = cla.empty(self.clqueue, tuple(grid.shape),
+      grid.storage_dtype(), allocator=self.cldevice.allocator)
+
+    if self.is_interleaved():
+      outimgcl.clprogram.interpolateInterleaved(outimgcl.clqueue, grid.shape,
+        None,
+        grid.clsize.data,
+        vol.clarray.data,
+        vol.clsize.data, vol.clspacing.data,
+        self.clh.data,
+        outimgcl.clarray.data,
+        grid.clspacing.data, np.uint32(self.displacement)).wait()
+      return outimgcl
 
     outimgcl.clprogram.interpolate(outimgcl.clqueue, self.hx.shape, None,
+      self.hx.clsize.data,
       vol.clarray.data,
       vol.clsize.data, vol.clspacing.data,
       self.hx.clarray.data, self.hy.clarray.data, self.hz.clarray.data,
-      outimgcl.clarray.data).wait()
+      outimgcl.clarray.data,
+      self.hx.clspacing.data, np.uint32(self.displacement)).wait()
 
     return outimgcl
 
   def compose(self, otherdef):
-    hx_new = otherdef.applyTo(self.hx)
-    hy_new = otherdef.applyTo(self.hy)
-    hz_new = otherdef.applyTo(self.hz)
+    # Result uses the layout and representation of self
+    if otherdef.is_interleaved() != self.is_interleaved():
+      if self.is_interleaved():
+        otherdef = otherdef.to_interleaved()
+      else:
+        otherdef = otherdef.to_planar()
+    if otherdef.displacement != self.displacement:
+      if self.displacement:
+        otherdef = otherdef.to_displacement()
+      else:
+        otherdef = otherdef.to_absolute()
+
+    if self.is_interleaved():
+      grid = otherdef.clgrid
+      outdef = DeformationCL.empty_like(grid, interleaved=True,
+        displacement=self.displacement)
+      self.clprogram.interpolate3Interleaved(otherdef.clqueue, grid.shape,
+        None,
+        grid.clsize.data,
+        self.clh.data,
+        self.clgrid.clsize.data, self.clgrid.clspacing.data,
+        otherdef.clh.data,
+        outdef.clh.data,
+        grid.clspacing.data, np.uint32(self.displacement)).wait()
+      return outdef
+
+    # All three components interpolated at otherdef in one pass
+    hx_new = otherdef.hx.clone_empty()
+    hy_new = otherdef.hx.clone_empty()
+    hz_new = otherdef.hx.clone_empty()
+    for h in (hx_new, hy_new, hz_new):
+      h.clarray = cla.empty(otherdef.clqueue, tuple(otherdef.hx.shape),
+        otherdef.hx.storage_dtype(), allocator=otherdef.cldevice.allocator)
+
+    self.clprogram.interpolate3(otherdef.clqueue, otherdef.hx.shape, None,
+      otherdef.hx.clsize.data,
+      self.hx.clarray.data, self.hy.clarray.data, self.hz.clarray.data,
+      self.hx.clsize.data, self.hx.clspacing.data,
+      otherdef.hx.clarray.data, otherdef.hy.clarray.data,
+      otherdef.hz.clarray.data,
+      hx_new.clarray.data, hy_new.clarray.data, hz_new.clarray.data,
+      otherdef.hx.clspacing.data, np.uint32(self.displacement)).wait()
 
     H_new = [hx_new, hy_new, hz_new]
 
-    outdef = DeformationCL(otherdef.clgrid, H_new)
+    outdef = DeformationCL(otherdef.clgrid, H_new,
+      displacement=self.displacement)
 
     H_new = None
 
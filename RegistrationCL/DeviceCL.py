@@ -0,0 +1,137 @@
+#
+# DeviceCL: process-wide manager of CL device resources
+#
+# Owns a single CL context per preferred device type, along with command
+# queues and the programs built from ImageFunctions.cl.in. All ImageCL,
+# DeformationCL, and PolyAffineCL objects share these so that device memory
+# lives in one context and buffers can be copied without host round trips.
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+import pyopencl as cl
+
+import os
+
+from ProgramCache import ProgramCache
+from MemoryPoolCL import MemoryPoolCL
+
+class DeviceCL:
+
+  # Shared device managers, with preferred device type as key
+  instances = { }
+
+  # On-disk cache of compiled program binaries, set to None to always build
+  # programs from source
+  programCache = ProgramCache()
+
+  # Number of CL programs set up, useful for benchmarking
+  programBuilds = 0
+
+  @staticmethod
+  def get(preferredDeviceType="GPU"):
+    """Returns the shared device manager for a device type"""
+    if not DeviceCL.instances.has_key(preferredDeviceType):
+      DeviceCL.instances[preferredDeviceType] = DeviceCL(preferredDeviceType)
+    return DeviceCL.instances[preferredDeviceType]
+
+  def __init__(self, preferredDeviceType="GPU", numQueues=1):
+
+    self.preferredDeviceType = preferredDeviceType
+
+    # Create cl context and queues
+    self.clcontext = None
+    for platform in cl.get_platforms():
+      for device in platform.get_devices():
+        if cl.device_type.to_string(device.type) == preferredDeviceType:
+          self.clcontext = cl.Context([device])
+          print ("Setting up CL device: %s" % cl.device_type.to_string(
+            device.type))
+          break;
+      if self.clcontext is not None:
+        break
+    if self.clcontext is None:
+      print "WARNING: using default CL context"
+      self.clcontext = cl.create_some_context()
+
+    self.clqueues = []
+    for i in xrange(max(numQueues, 1)):
+      self.clqueues.append(cl.CommandQueue(self.clcontext))
+    self.clqueue = self.clqueues[0]
+
+    # Programs built from ImageFunctions.cl.in, with build options as key
+    self.clprograms = { }
+
+    # Allocator for image buffers, None uses the CL runtime directly
+    self.allocator = None
+
+    # Generated kernels (e.g. fused image expressions), with signature as key
+    self.kernels = { }
+
+    # Print CL device info
+    print "Created new CL context for device type", preferredDeviceType
+    device = self.clcontext.devices[0]
+    print("Device name:", device.name)
+    print("Device type:", cl.device_type.to_string(device.type))
+    print("Device memory: ", device.global_mem_size//1024//1024, 'MB')
+    print("Device max clock speed:", device.max_clock_frequency, 'MHz')
+    print("Device compute units:", device.max_compute_units)
+
+    self.clprogram = self.get_program()
+
+  def get_queue(self, index=0):
+    """Returns command queue at index, creating it if needed"""
+    while len(self.clqueues) <= index:
+      self.clqueues.append(cl.CommandQueue(self.clcontext))
+    return self.clqueues[index]
+
+  def enable_memory_pool(self, maxHeldBlocks=64, maxHeldBytes=None):
+    """Use pooled allocator for image buffers created from now on"""
+    if self.allocator is None:
+      self.allocator = MemoryPoolCL(self.clqueue, maxHeldBlocks, maxHeldBytes)
+    else:
+      self.allocator.maxHeldBlocks = maxHeldBlocks
+      self.allocator.maxHeldBytes = maxHeldBytes
+    return self.allocator
+
+  def disable_memory_pool(self):
+    """Allocate new image buffers directly, releasing blocks held in pool"""
+    if self.allocator is not None:
+      self.allocator.trim()
+    self.allocator = None
+
+  def trim_memory_pool(self):
+    """Release memory held by the pool but not in use"""
+    if self.allocator is not None:
+      self.allocator.trim()
+
+  def get_kernel(self, key, builder):
+    """Returns memoized generated kernel, calling builder() on first use"""
+    if not self.kernels.has_key(key):
+      self.kernels[key] = builder()
+    return self.kernels[key]
+
+  def get_program(self, options=""):
+    """Returns program built from ImageFunctions.cl.in with build options"""
+
+    if self.clprograms.has_key(options):
+      return self.clprograms[options]
+
+    # Compile OpenCL code and create program object
+    sourcePath = os.path.dirname( os.path.realpath(__file__) )
+    clFileName = os.path.join(sourcePath, "ImageFunctions.cl.in")
+
+    fp = open(clFileName)
+    source = fp.read()
+    fp.close()
+
+    if DeviceCL.programCache is not None:
+      program = DeviceCL.programCache.build(self.clcontext, source, options)
+    else:
+      program = cl.Program(self.clcontext, source).build(options)
+
+    DeviceCL.programBuilds += 1
+
+    self.clprograms[options] = program
+
+    return program
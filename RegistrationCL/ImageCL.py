@@ -7,6 +7,27 @@
 #
 # Requires the program in ImageFunctions.cl
 #
+# Voxel data is stored as float by default. With storage="half" it is stored
+# as 16 bit floats and converted to float on access, halving device memory
+# and bandwidth. Half has an 11 bit significand, about 3 decimal digits, so
+# it suits normalized intensities, forces, velocities, and displacement
+# fields (DeformationCL displacement=True) but not absolute coordinates,
+# which for a 256 mm field of view are only resolved to 0.125 mm. Reductions
+# accumulate in float. Images used together in one operation must share the
+# same storage, PolyAffineCL and interleaved DeformationCL fields require
+# float images.
+#
+# Memory held between iterations of SteeredFluidRegistration is 9 volumes
+# (fixed, moving, output, and two 3 component fields):
+#
+#   256^3 voxels: float  604 MB, half  302 MB
+#   512^3 voxels: float 4832 MB, half 2416 MB
+#
+# Warping an image reads 3 field values and up to 8 voxels and writes one
+# voxel, 48 bytes per voxel in float and 24 in half. These are counts, not
+# measurements; speed and the difference between half and float results have
+# not been measured yet, Testing/benchmarkHalfStorage.py reports both.
+#
 # Author: Marcel Prastawa (marcel.prastawa@gmail.com)
 #
 
@@ -15,20 +36,35 @@ import vtk
 import pyopencl as cl
 import pyopencl.array as cla
 import pyopencl.clmath as clmath
+from pyopencl.elementwise import ElementwiseKernel
+from pyopencl.reduction import ReductionKernel
 
 import numpy as np
 
-import os
+from DeviceCL import DeviceCL
+from ImageExpressionCL import ImageExpressionCL
 
 class ImageCL:
 
-  # Cache of CL programs, with image size tuple as key
-  clSetupCache = { }
+  # Numpy type and program build options for each storage type
+  storageDtypes = { "float" : np.float32, "half" : np.float16 }
+  storageOptions = { "float" : "", "half" : "-DSTORAGE_HALF" }
+
+  # Lines filtered together by a work group in recursive_gaussian, staged in
+  # local memory. Lines too long for the tile use one work item per line
+  # reading global memory, as do all lines when useTiledGaussian is False.
+  gaussianTileLines = 16
+  useTiledGaussian = True
 
-  def __init__(self, preferredDeviceType="GPU"):
+  def __init__(self, preferredDeviceType="GPU", storage="float"):
 
     self.preferredDeviceType = preferredDeviceType
 
+    # Type of voxel data on the device, "float" or "half"
+    if not ImageCL.storageDtypes.has_key(storage):
+      raise ValueError("Unknown image storage " + str(storage))
+    self.storage = storage
+
     self.origin = [0.0, 0.0, 0.0]
     self.shape = [0, 0, 0]
     self.spacing = [1.0, 1.0, 1.0]
@@ -37,76 +73,42 @@ class ImageCL:
     self.clsize = None
     self.clspacing = None
 
+    self.cldevice = None
     self.clcontext = None
     self.clqueue = None
     self.clprogram = None
 
   def __del__(self):
+    # Releasing the array returns its buffer to the memory pool, if enabled
     self.clarray = None
     self.clsize = None
     self.clspacing = None
 
   def setup(self):
-    """Setup CL context, queue, and program."""
-
-    cacheKey = tuple(self.shape)
-    if ImageCL.clSetupCache.has_key(cacheKey):
-
-      clTuple = ImageCL.clSetupCache[cacheKey]
-
-      self.clcontext = clTuple[0]
-      self.clqueue = clTuple[1]
-      self.clprogram = clTuple[2]
-
-      return
+    """Setup CL context, queue, and program from the shared device."""
 
-    # Create cl context and queue
-    self.clcontext = None
-    for platform in cl.get_platforms():
-      for device in platform.get_devices():
-        if cl.device_type.to_string(device.type) == self.preferredDeviceType:
-          self.clcontext = cl.Context([device])
-          print ("Setting up CL device: %s" % cl.device_type.to_string(
-            device.type))
-          break;
-    if self.clcontext is None:
-      print "WARNING: using default CL context"
-      self.clcontext = cl.create_some_context()
-
-    self.clqueue = cl.CommandQueue(self.clcontext)
-
-    # Print CL device info
-    print "Created new CL context and program for image size", self.shape
-    device = self.clcontext.devices[0]
-    print("Device name:", device.name)
-    print("Device type:", cl.device_type.to_string(device.type))
-    print("Device memory: ", device.global_mem_size//1024//1024, 'MB')
-    print("Device max clock speed:", device.max_clock_frequency, 'MHz')
-    print("Device compute units:", device.max_compute_units)
-
-    # Compile OpenCL code and create program object
-    sourcePath = os.path.dirname( os.path.realpath(__file__) )
-    clFileName = os.path.join(sourcePath, "ImageFunctions.cl.in")
+    self.cldevice = DeviceCL.get(self.preferredDeviceType)
 
-    fp = open(clFileName)
-    sourceTemplate = fp.read()
-    fp.close()
+    self.clcontext = self.cldevice.clcontext
+    self.clqueue = self.cldevice.clqueue
+    self.clprogram = self.cldevice.get_program(
+      ImageCL.storageOptions[self.storage])
 
-    slices, rows, columns = self.shape
-    source = sourceTemplate % {
-      'slices' : slices,
-      'rows' : rows,
-      'columns' : columns,
-      }
-
-    self.clprogram = cl.Program(self.clcontext, source).build()
+  def setup_geometry(self):
+    """Upload size and spacing to CL arrays"""
+    nspacing = np.zeros((3,), dtype=np.float32)
+    for dim in xrange(3):
+      nspacing[dim] = self.spacing[dim]
+    self.clspacing = cla.to_device(self.clqueue, nspacing)
 
-    ImageCL.clSetupCache[tuple(self.shape)] = \
-      (self.clcontext, self.clqueue, self.clprogram)
+    nsize = np.zeros((3,), dtype=np.uint32)
+    for dim in xrange(3):
+      nsize[dim] = self.shape[dim]
+    self.clsize = cla.to_device(self.clqueue, nsize)
 
   def clone_empty(self):
     """Clone self without filling in CL array data"""
-    outimgcl = ImageCL(self.preferredDeviceType)
+    outimgcl = ImageCL(self.preferredDeviceType, self.storage)
     outimgcl.origin = list(self.origin)
     outimgcl.shape = list(self.shape)
     outimgcl.spacing = list(self.spacing)
@@ -117,6 +119,7 @@ class ImageCL:
     if self.clspacing is not None:
       outimgcl.clspacing = self.clspacing.copy()
 
+    outimgcl.cldevice = self.cldevice
     outimgcl.clcontext = self.clcontext
     outimgcl.clqueue = self.clqueue
     outimgcl.clprogram = self.clprogram
@@ -129,12 +132,36 @@ class ImageCL:
     if self.clarray is not None:
       outimgcl.clarray = self.clarray.copy()
 
+    outimgcl.cldevice = self.cldevice
     outimgcl.clcontext = self.clcontext
     outimgcl.clqueue = self.clqueue
     outimgcl.clprogram = self.clprogram
 
     return outimgcl
 
+  def storage_dtype(self):
+    """Returns numpy type of voxel data on the device"""
+    return ImageCL.storageDtypes[self.storage]
+
+  def is_half(self):
+    return self.storage == "half"
+
+  def to_storage(self, storage):
+    """Returns copy of self with voxel data stored as storage type"""
+    if storage == self.storage:
+      return self.clone()
+
+    outimgcl = self.clone_empty()
+    outimgcl.storage = storage
+    outimgcl.clprogram = self.cldevice.get_program(
+      ImageCL.storageOptions[storage])
+    outimgcl.clarray = cla.empty(self.clqueue, tuple(self.shape),
+      outimgcl.storage_dtype(), allocator=self.cldevice.allocator)
+
+    self.lazy().evaluate_into(outimgcl)
+
+    return outimgcl
+
   def fromVolume(self, volume):
     """Fill data using a MRML volume node"""
 
@@ -160,15 +187,7 @@ class ImageCL:
     self.originalIJKToRAS = vtk.vtkMatrix4x4()
     volume.GetIJKToRASDirectionMatrix(self.originalIJKToRAS)
 
-    nspacing = np.zeros((3,), dtype=np.float32)
-    for dim in xrange(3):
-      nspacing[dim] = self.spacing[dim]
-    self.clspacing = cla.to_device(self.clqueue, nspacing)
-
-    nsize = np.zeros((3,), dtype=np.uint32)
-    for dim in xrange(3):
-      nsize[dim] = self.shape[dim]
-    self.clsize = cla.to_device(self.clqueue, nsize)
+    self.setup_geometry()
 
     # VTK image data is stored in reverse order
     reverse_shape = list(vtkimage.GetDimensions())
@@ -178,8 +197,9 @@ class ImageCL:
         #vtkimage.GetPointData().GetScalars()).reshape(self.shape)
     narray = np.asfortranarray(narray)
     narray = narray.transpose(2, 1, 0)
-    narray = narray.astype('float32')
-    self.clarray = cl.array.to_device(self.clqueue, narray)
+    narray = narray.astype(self.storage_dtype())
+    self.clarray = cl.array.to_device(self.clqueue, narray,
+      allocator=self.cldevice.allocator)
 
     vtkimage = None
 
@@ -193,21 +213,14 @@ class ImageCL:
 
     self.setup()
 
-    nspacing = np.zeros((3,), dtype=np.float32)
-    for dim in xrange(3):
-      nspacing[dim] = self.spacing[dim]
-    self.clspacing = cla.to_device(self.clqueue, nspacing)
-
-    nsize = np.zeros((3,), dtype=np.uint32)
-    for dim in xrange(3):
-      nsize[dim] = self.shape[dim]
-    self.clsize = cla.to_device(self.clqueue, nsize)
+    self.setup_geometry()
 
-    narray = imarray.astype('float32')
-    self.clarray = cl.array.to_device(self.clqueue, narray)
+    narray = imarray.astype(self.storage_dtype())
+    self.clarray = cl.array.to_device(self.clqueue, narray,
+      allocator=self.cldevice.allocator)
 
-  def getROI(self, center, radius):
-    """Extract ImageCL object at an ROI defined by center and radius"""
+  def getROIBounds(self, center, radius):
+    """Returns voxel bounds [X0, X1) of an ROI defined by center and radius"""
 
     # Convert radius to voxels
     voxrad = [1,1,1]
@@ -229,33 +242,74 @@ class ImageCL:
       p1 = min(self.shape[d]-1, p1)
 
       X0[d] = p0
-      X1[d] = p1
+      # Keep at least one voxel in the ROI
+      X1[d] = max(p1, p0+1)
+
+    return X0, X1
 
-    #print "C", center
-    #print "r", radius
-    #print "X0", X0
-    #print "X1", X1
+  def getROI(self, center, radius):
+    """
+    Extract ImageCL object at an ROI defined by center and radius.
+    The ROI is copied on the device, its voxel offset in this image is
+    stored in roiOffset and its physical origin in roiOrigin.
+    """
 
-    arr = self.clarray.get()
-    subarr = arr[X0[0]:X1[0], X0[1]:X1[1], X0[2]:X1[2]]
+    X0, X1 = self.getROIBounds(center, radius)
 
-    #subclarray = self.clarray[X0[0]:X1[0], X0[1]:X1[1], X0[2]:X1[2]]
-    #subarr = subclarray.get()
+    roiShape = [X1[d] - X0[d] for d in range(3)]
 
-    #print "subarr shape", subarr.shape
+    outimgcl = ImageCL(self.preferredDeviceType, self.storage)
+    outimgcl.shape = roiShape
+    # Keep origin of the full image, kernels operating on the ROI assume it
+    outimgcl.origin = list(self.origin)
+    outimgcl.spacing = list(self.spacing)
+    outimgcl.setup()
+    outimgcl.setup_geometry()
 
-    origin = list(self.origin)
-    #for dim in range(3):
-    #  origin[dim] += X0[dim]*self.spacing[dim]
+    outimgcl.clarray = cla.empty(self.clqueue, tuple(roiShape),
+      self.storage_dtype(), allocator=self.cldevice.allocator)
 
-    outimgcl = ImageCL(self.preferredDeviceType)
-    outimgcl.fromArray(subarr, origin, self.spacing)
+    self.copyBlock(self.clarray, X0, outimgcl.clarray, [0,0,0], roiShape)
 
-    # TODO: store region info to allow recompositing?
-    #return outimgcl, X0, X1
+    outimgcl.roiOffset = list(X0)
+    outimgcl.roiOrigin = [0.0, 0.0, 0.0]
+    for dim in range(3):
+      outimgcl.roiOrigin[dim] = self.origin[dim] + X0[dim]*self.spacing[dim]
 
     return outimgcl
 
+  def setROI(self, roiimgcl):
+    """Write ROI obtained through getROI back into this image"""
+    self.copyBlock(roiimgcl.clarray, [0,0,0],
+      self.clarray, roiimgcl.roiOffset, roiimgcl.shape)
+
+  def addROI(self, roiimgcl):
+    """Add ROI obtained through getROI into this image"""
+    blockimgcl = roiimgcl.clone_empty()
+    blockimgcl.clarray = cla.empty_like(roiimgcl.clarray)
+    self.copyBlock(self.clarray, roiimgcl.roiOffset,
+      blockimgcl.clarray, [0,0,0], roiimgcl.shape)
+    blockimgcl.add_inplace(roiimgcl)
+    self.copyBlock(blockimgcl.clarray, [0,0,0],
+      self.clarray, roiimgcl.roiOffset, roiimgcl.shape)
+
+  def copyBlock(self, srcarray, srcOffset, dstarray, dstOffset, region):
+    """Device to device copy of a rectangular block between CL arrays"""
+
+    # CL rectangular copies list the fastest varying dimension first, with
+    # its offset and extent in bytes
+    itemsize = srcarray.dtype.itemsize
+
+    srcShape = srcarray.shape
+    dstShape = dstarray.shape
+
+    cl.enqueue_copy(self.clqueue, dstarray.data, srcarray.data,
+      src_origin=(srcOffset[2]*itemsize, srcOffset[1], srcOffset[0]),
+      dst_origin=(dstOffset[2]*itemsize, dstOffset[1], dstOffset[0]),
+      region=(region[2]*itemsize, region[1], region[0]),
+      src_pitches=(srcShape[2]*itemsize, srcShape[1]*srcShape[2]*itemsize),
+      dst_pitches=(dstShape[2]*itemsize, dstShape[1]*dstShape[2]*itemsize))
+
   def toVTKImage(self):
     """Returns vtkImageData containing image from GPU memory"""
     narray = self.clarray.get().astype('float32')
@@ -290,6 +344,13 @@ class ImageCL:
 
   def fill(self, value):
     """Fill GPU data with scalar"""
+    if self.is_half():
+      def builder():
+        return ElementwiseKernel(self.clcontext, "half *x, float v",
+          "vstore_half(v, i, x)", "fill_half")
+      knl = self.cldevice.get_kernel(("fill_half",), builder)
+      knl(self.clarray, np.float32(value), queue=self.clqueue)
+      return
     self.clarray.fill(value)
 
   def normalize(self):
@@ -304,73 +365,123 @@ class ImageCL:
     # in header include location
     # WORKAROUND: edit Program Files/Slicer/lib/Python/Lib/site-packages/pyopencl/reduction.py
     # insert code from cl/pyopencl-complex.h manually and comment include
-    clminp = cl.array.min(self.clarray, self.clqueue)
-    clmaxp = cl.array.max(self.clarray, self.clqueue)
-    # Convert reductions to scalars
-    minp = clminp.get()[()]
-    maxp = clmaxp.get()[()]
+    minp, maxp = self.minmax()
 
+    # Rescale in a single fused kernel
     range = maxp - minp
     if range > 0.0:
-      self.clarray -= minp
-      self.clarray /= range
+      self.lazy().subtract(minp).multiply(1.0 / range).evaluate_into(self)
+
+  def lazy(self):
+    """
+    Returns lazy expression on this image, operations on it are fused into
+    one kernel at a terminal operation (sum, min, max, materialize)
+    """
+    return ImageExpressionCL.wrap(self)
+
+  # Operations on half images run as fused expressions, which load and
+  # store half while computing in float
 
   def scale(self, v):
+    if self.is_half():
+      self.lazy().multiply(v).evaluate_into(self)
+      return
     self.clarray *= v
 
   def shift(self, v):
+    if self.is_half():
+      self.lazy().add(v).evaluate_into(self)
+      return
     self.clarray += v
     
   def add(self, otherimgcl):
+    if self.is_half():
+      return self.lazy().add(otherimgcl).materialize()
     outimgcl = self.clone_empty()
     outimgcl.clarray = self.clarray + otherimgcl.clarray
     return outimgcl
     
   def subtract(self, otherimgcl):
+    if self.is_half():
+      return self.lazy().subtract(otherimgcl).materialize()
     outimgcl = self.clone_empty()
     outimgcl.clarray = self.clarray - otherimgcl.clarray
     return outimgcl
     
   def multiply(self, otherimgcl):
+    if self.is_half():
+      return self.lazy().multiply(otherimgcl).materialize()
     outimgcl = self.clone_empty()
     outimgcl.clarray = self.clarray * otherimgcl.clarray
     return outimgcl
 
   def divide(self, otherimgcl):
+    if self.is_half():
+      return self.lazy().divide(otherimgcl).materialize()
     outimgcl = self.clone_empty()
     outimgcl.clarray = self.clarray / otherimgcl.clarray
     return outimgcl
     
   def exp(self):
+    if self.is_half():
+      return self.lazy().exp().materialize()
     outimgcl = self.clone_empty()
     outimgcl.clarray = clmath.exp(self.clarray)
     return outimgcl
 
   def add_inplace(self, otherimgcl):
+    if self.is_half():
+      self.lazy().add(otherimgcl).evaluate_into(self)
+      return self
     self.clarray += otherimgcl.clarray
     return self
 
   def subtract_inplace(self, otherimgcl):
+    if self.is_half():
+      self.lazy().subtract(otherimgcl).evaluate_into(self)
+      return self
     self.clarray -= otherimgcl.clarray
     return self
 
   def multiply_inplace(self, otherimgcl):
+    if self.is_half():
+      self.lazy().multiply(otherimgcl).evaluate_into(self)
+      return self
     self.clarray *= otherimgcl.clarray
     return self
 
   def divide_inplace(self, otherimgcl):
+    if self.is_half():
+      self.lazy().divide(otherimgcl).evaluate_into(self)
+      return self
     self.clarray /= otherimgcl.clarray
     return self
 
   def minmax(self):
-    #TODO
-    #use cl.reduction.ReductionKernel
-    #https://github.com/pyopencl/pyopencl/blob/master/examples/demo-struct-reduce.py
-    pass
+    """Returns min and max intensities computed in a single reduction"""
+
+    # NOTE: see note on normalize()
+    value = ImageExpressionCL.load(self, "x")
+    def builder():
+      return ReductionKernel(self.clcontext, cla.vec.float2,
+        neutral="(float2)(INFINITY, -INFINITY)",
+        reduce_expr="(float2)(fmin(a.x, b.x), fmax(a.y, b.y))",
+        map_expr="(float2)(%s, %s)" % (value, value),
+        arguments=ImageExpressionCL.declaration(self, "x"))
+    knl = self.cldevice.get_kernel(("minmax", self.storage), builder)
+
+    clminmaxp = knl(self.clarray, queue=self.clqueue)
+
+    # Convert reduction to scalars with one read
+    minmaxp = clminmaxp.get()
+    return float(minmaxp["x"]), float(minmaxp["y"])
 
   def min(self):
     #return self.clarray.get().min()
 
+    if self.is_half():
+      return self.lazy().min()
+
     # NOTE: see note on normalize()
     clminp = cl.array.min(self.clarray, self.clqueue)
     minp = clminp.get()[()]
@@ -379,6 +490,9 @@ class ImageCL:
   def max(self):
     #return self.clarray.get().max()
 
+    if self.is_half():
+      return self.lazy().max()
+
     # NOTE: see note on normalize()
     clmaxp = cl.array.max(self.clarray, self.clqueue)
     maxp = clmaxp.get()[()]
@@ -387,6 +501,9 @@ class ImageCL:
   def sum(self):
     #return self.clarray.get().sum()
 
+    if self.is_half():
+      return self.lazy().sum()
+
     clsump = cl.array.sum(self.clarray, np.float32, self.clqueue)
     sump = clsump.get()[()]
     return sump
@@ -399,6 +516,7 @@ class ImageCL:
 
     #self.clprogram.gradient_central(self.clqueue, self.shape, None,
     self.clprogram.gradient_forward(self.clqueue, self.shape, None,
+      self.clsize.data,
       self.clarray.data,
       self.clspacing.data,
       gradx.clarray.data, grady.clarray.data, gradz.clarray.data).wait()
@@ -407,11 +525,9 @@ class ImageCL:
 
   def gradient_magnitude(self):
     [gx, gy, gz] = self.gradient()
-    mag = gx.multiply(gx)
-    mag.add_inplace(gy.multiply(gy))
-    mag.add_inplace(gz.multiply(gz))
+    mag = gx.lazy().square().add(gy.lazy().square()).add(gz.lazy().square())
 
-    return mag
+    return mag.materialize()
 
   def discrete_gaussian(self, sigma):
     """Discrete / convolutional Gaussian smoothing on GPU"""
@@ -423,6 +539,7 @@ class ImageCL:
     varx = np.float32(sx * sx)
     widthx = np.int32(3 * sx)
     self.clprogram.gaussian_x(self.clqueue, self.shape, None,
+      self.clsize.data,
       tempclarray.data,
       varx, widthx, outimgcl.clarray.data).wait()
 
@@ -430,6 +547,7 @@ class ImageCL:
     vary = np.float32(sx * sy)
     widthy = np.int32(3 * sy)
     self.clprogram.gaussian_y(self.clqueue, self.shape, None,
+      self.clsize.data,
       outimgcl.clarray.data,
       vary, widthy,
       tempclarray.data).wait()
@@ -438,6 +556,7 @@ class ImageCL:
     varz = np.float32(sx * sz)
     widthz = np.int32(3 * sz)
     self.clprogram.gaussian_z(self.clqueue, self.shape, None,
+      self.clsize.data,
       tempclarray.data,
       varz, widthz,
       outimgcl.clarray.data).wait()
@@ -448,26 +567,68 @@ class ImageCL:
     """Recursive Gaussian smoothing on GPU"""
     outimgcl = self.clone()
 
-    sizeX = self.shape[0]
-    sizeY = self.shape[1]
-    sizeZ = self.shape[2]
+    for axis in (2, 1, 0):
+      outimgcl._recursive_gaussian_axis(axis,
+        np.float32(sigma / self.spacing[axis]))
 
-    sz = np.float32(sigma / self.spacing[2])
-    outimgcl.clprogram.recursive_gaussian_z(outimgcl.clqueue,
-      (sizeX, sizeY), None,
-      outimgcl.clarray.data, sz).wait()
+    return outimgcl
 
-    sy = np.float32(sigma / self.spacing[1])
-    outimgcl.clprogram.recursive_gaussian_y(outimgcl.clqueue,
-      (sizeX, sizeZ), None,
-      outimgcl.clarray.data, sy).wait()
+  def _recursive_gaussian_axis(self, axis, sigmaVoxels):
+    """Filter along one axis in-place, sigma in voxels"""
+
+    sizeX, sizeY, sizeZ = self.shape
+
+    # Voxels per line, voxel stride, number and stride of lines along the
+    # first launch dimension, and stride along the second
+    if axis == 2:
+      count, stride = sizeZ, 1
+      numLines, lineStride = sizeY, sizeZ
+      numLines1, lineStride1 = sizeX, sizeY*sizeZ
+    elif axis == 1:
+      count, stride = sizeY, sizeZ
+      numLines, lineStride = sizeZ, 1
+      numLines1, lineStride1 = sizeX, sizeY*sizeZ
+    else:
+      count, stride = sizeX, sizeY*sizeZ
+      numLines, lineStride = sizeZ, 1
+      numLines1, lineStride1 = sizeY, sizeZ
+
+    tileLines = self._get_gaussian_tile_lines(count)
+
+    if tileLines == 0:
+      knl = [self.clprogram.recursive_gaussian_x,
+        self.clprogram.recursive_gaussian_y,
+        self.clprogram.recursive_gaussian_z][axis]
+      knl(self.clqueue, (numLines, numLines1), None,
+        self.clsize.data, self.clarray.data, sigmaVoxels).wait()
+      return
 
-    sx = np.float32(sigma / self.spacing[0])
-    outimgcl.clprogram.recursive_gaussian_x(outimgcl.clqueue,
-      (sizeY, sizeZ), None,
-      outimgcl.clarray.data, sx).wait()
+    numGroups = (numLines + tileLines - 1) / tileLines
 
-    return outimgcl
+    self.clprogram.recursive_gaussian_tiled(self.clqueue,
+      (numGroups * tileLines, numLines1), (tileLines, 1),
+      self.clsize.data, self.clarray.data, sigmaVoxels,
+      np.uint32(count), np.uint32(stride),
+      np.uint32(numLines), np.uint32(lineStride), np.uint32(lineStride1),
+      cl.LocalMemory(tileLines * count * 4)).wait()
+
+  def _get_gaussian_tile_lines(self, count):
+    """Returns lines per work group for tiled filtering of lines with count
+    voxels, or 0 if they do not fit in local memory"""
+    if not ImageCL.useTiledGaussian:
+      return 0
+
+    device = self.clcontext.devices[0]
+    localBytes = device.local_mem_size
+    maxLines = min(ImageCL.gaussianTileLines, device.max_work_group_size)
+
+    tileLines = 1
+    while tileLines*2 <= maxLines and tileLines*2*count*4 <= localBytes:
+      tileLines *= 2
+
+    if tileLines*count*4 > localBytes:
+      return 0
+    return tileLines
 
   def get_resampled_spacing(self, targetShape):
     re_spacing = [1.0, 1.0, 1.0]
@@ -501,27 +662,15 @@ class ImageCL:
       outimgcl.clsize[dim] = targetShape[dim]
       outimgcl.clspacing[dim] = outimgcl.spacing[dim]
 
-    outimgcl.clarray = cl.array.zeros(self.clqueue, targetShape, np.float32)
-
-    hxclarray = cl.array.zeros_like(outimgcl.clarray)
-    hyclarray = cl.array.zeros_like(outimgcl.clarray)
-    hzclarray = cl.array.zeros_like(outimgcl.clarray)
+    outimgcl.clarray = cl.array.empty(self.clqueue, targetShape,
+      self.storage_dtype(), allocator=self.cldevice.allocator)
 
-    outimgcl.clprogram.identity(outimgcl.clqueue, targetShape, None,
-      outimgcl.clspacing.data,
-      hxclarray.data,  hyclarray.data, hzclarray.data).wait()
-    
-    outimgcl.clprogram.interpolate(outimgcl.clqueue, targetShape, None,
-      #self.clarray.data,
+    outimgcl.clprogram.resampleGrid(outimgcl.clqueue, targetShape, None,
+      outimgcl.clsize.data, outimgcl.clspacing.data,
       smoothimgcl.clarray.data,
       self.clsize.data, self.clspacing.data,
-      hxclarray.data, hyclarray.data, hzclarray.data,
       outimgcl.clarray.data).wait()
 
-    hxclarray = None
-    hyclarray = None
-    hzclarray = None
-
     return outimgcl
 
   @staticmethod
@@ -544,6 +693,7 @@ class ImageCL:
     numV = np.uint32(posM.shape[0])
 
     clprogram.add_splat3(clqueue, shape, None,
+      clsize.data,
       clposM.data,
       clvalueM.data,
       clsigmaM.data,
@@ -0,0 +1,229 @@
+#
+# ImageExpressionCL: lazy voxel-wise expressions on ImageCL objects
+#
+# Arithmetic on an expression builds a tree instead of launching kernels.
+# Terminal operations (sum, min, max, materialize) compile the tree into a
+# single generated elementwise or reduction kernel, so that a chain of N
+# operators costs one pass over memory instead of N passes and N temporary
+# buffers. Generated kernels are memoized per device by expression
+# signature, scalar values are passed as kernel arguments.
+#
+# Images with half storage (ImageCL.storage) are read with vload_half and
+# written with vstore_half, expressions and reductions are evaluated and
+# accumulated in float.
+#
+# Usage:
+#   ssd = fixedCL.lazy().subtract(movingCL).square().sum()
+#
+# Requires: ImageCL
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+import pyopencl.array as cla
+from pyopencl.elementwise import ElementwiseKernel
+from pyopencl.reduction import ReductionKernel
+
+import numpy as np
+
+class ImageExpressionCL:
+
+  def __init__(self, op, children=[], image=None, value=None):
+
+    # Node type: "image", "scalar", or an operator name
+    self.op = op
+    self.children = list(children)
+
+    self.image = image
+    self.value = value
+
+  @staticmethod
+  def load(imgcl, name):
+    """Returns C expression reading voxel i of image argument name"""
+    if getattr(imgcl, "storage", "float") == "half":
+      return "vload_half(i, %s)" % name
+    return "%s[i]" % name
+
+  @staticmethod
+  def store(imgcl, name, value):
+    """Returns C statement writing value to voxel i of image argument name"""
+    if getattr(imgcl, "storage", "float") == "half":
+      return "vstore_half(%s, i, %s)" % (value, name)
+    return "%s[i] = %s" % (name, value)
+
+  @staticmethod
+  def declaration(imgcl, name):
+    """Returns C declaration of image argument name"""
+    return "%s *%s" % (getattr(imgcl, "storage", "float"), name)
+
+  @staticmethod
+  def wrap(x):
+    """Returns expression node for an expression, ImageCL, or scalar"""
+    if isinstance(x, ImageExpressionCL):
+      return x
+    if hasattr(x, "clarray"):
+      return ImageExpressionCL("image", image=x)
+    return ImageExpressionCL("scalar", value=float(x))
+
+  #
+  # Expression building
+  #
+
+  def add(self, other):
+    return ImageExpressionCL("+", [self, ImageExpressionCL.wrap(other)])
+
+  def subtract(self, other):
+    return ImageExpressionCL("-", [self, ImageExpressionCL.wrap(other)])
+
+  def multiply(self, other):
+    return ImageExpressionCL("*", [self, ImageExpressionCL.wrap(other)])
+
+  def divide(self, other):
+    return ImageExpressionCL("/", [self, ImageExpressionCL.wrap(other)])
+
+  def scale(self, v):
+    return self.multiply(v)
+
+  def shift(self, v):
+    return self.add(v)
+
+  def square(self):
+    return ImageExpressionCL("square", [self])
+
+  def exp(self):
+    return ImageExpressionCL("exp", [self])
+
+  def sqrt(self):
+    return ImageExpressionCL("sqrt", [self])
+
+  #
+  # Terminal operations
+  #
+
+  def materialize(self):
+    """Evaluate expression into a new ImageCL object, with the storage of
+    the first image in the expression"""
+    refimgcl = self._reference_image()
+    outimgcl = refimgcl.clone_empty()
+    outimgcl.clarray = cla.empty_like(refimgcl.clarray)
+    self.evaluate_into(outimgcl)
+    return outimgcl
+
+  def evaluate_into(self, outimgcl):
+    """Evaluate expression into an existing ImageCL object, which may also
+    appear in the expression"""
+    source, images, scalars = self._generate()
+
+    refimgcl = self._reference_image()
+
+    arguments = [ImageExpressionCL.declaration(outimgcl, "out")] + \
+      self._declarations(images, scalars)
+
+    operation = ImageExpressionCL.store(outimgcl, "out", source)
+
+    key = ("elementwise", operation, tuple(arguments), len(scalars))
+    def builder():
+      return ElementwiseKernel(refimgcl.clcontext, ", ".join(arguments),
+        operation, "image_expression")
+    knl = refimgcl.cldevice.get_kernel(key, builder)
+
+    args = [outimgcl.clarray] + self._arguments(images, scalars)
+    knl(*args, queue=refimgcl.clqueue)
+
+    return outimgcl
+
+  def sum(self):
+    return self._reduce("sum", "0.0f", "a+b")
+
+  def min(self):
+    return self._reduce("min", "INFINITY", "fmin(a,b)")
+
+  def max(self):
+    return self._reduce("max", "-INFINITY", "fmax(a,b)")
+
+  #
+  # Code generation
+  #
+
+  def _reduce(self, name, neutral, reduceExpr):
+    source, images, scalars = self._generate()
+
+    refimgcl = self._reference_image()
+
+    arguments = self._declarations(images, scalars)
+
+    key = ("reduction", name, source, tuple(arguments))
+    def builder():
+      return ReductionKernel(refimgcl.clcontext, np.float32,
+        neutral=neutral, reduce_expr=reduceExpr, map_expr=source,
+        arguments=", ".join(arguments))
+    knl = refimgcl.cldevice.get_kernel(key, builder)
+
+    args = self._arguments(images, scalars)
+    result = knl(*args, queue=refimgcl.clqueue)
+
+    return result.get()[()]
+
+  def _reference_image(self):
+    """Returns first image in the expression, defines shape and device"""
+    if self.op == "image":
+      return self.image
+    for child in self.children:
+      imgcl = child._reference_image()
+      if imgcl is not None:
+        return imgcl
+    return None
+
+  def _generate(self):
+    """Returns C expression for voxel i, list of images, and list of
+    scalars used as kernel arguments"""
+    images = []
+    scalars = []
+    source = self._generate_node(images, scalars)
+    return source, images, scalars
+
+  def _generate_node(self, images, scalars):
+    if self.op == "image":
+      # Same image appearing multiple times maps to one argument
+      index = None
+      for k in range(len(images)):
+        if images[k] is self.image:
+          index = k
+          break
+      if index is None:
+        index = len(images)
+        images.append(self.image)
+      return ImageExpressionCL.load(self.image, "x%d" % index)
+
+    if self.op == "scalar":
+      scalars.append(self.value)
+      return "s%d" % (len(scalars)-1)
+
+    args = [c._generate_node(images, scalars) for c in self.children]
+
+    if self.op in ("+", "-", "*", "/"):
+      return "(%s %s %s)" % (args[0], self.op, args[1])
+    if self.op == "square":
+      return "(%s * %s)" % (args[0], args[0])
+    if self.op == "exp":
+      return "exp(%s)" % args[0]
+    if self.op == "sqrt":
+      return "sqrt(%s)" % args[0]
+
+    raise ValueError("Unknown image expression operator " + self.op)
+
+  def _declarations(self, images, scalars):
+    decl = []
+    for k in range(len(images)):
+      decl.append(ImageExpressionCL.declaration(images[k], "x%d" % k))
+    for k in range(len(scalars)):
+      decl.append("float s%d" % k)
+    return decl
+
+  def _arguments(self, images, scalars):
+    args = []
+    for imgcl in images:
+      args.append(imgcl.clarray)
+    for v in scalars:
+      args.append(np.float32(v))
+    return args
@@ -0,0 +1,80 @@
+#
+# MemoryPoolCL: pooled allocator for CL array temporaries
+#
+# Wraps pyopencl.tools.MemoryPool so that buffers released by ImageCL and
+# DeformationCL temporaries are recycled instead of being returned to the
+# CL runtime, with limits on the memory held by the pool and counters for
+# profiling. Pass an instance as allocator when creating CL arrays, arrays
+# derived from them (arithmetic results, copies) use the same allocator.
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+import pyopencl.tools as cltools
+
+class MemoryPoolCL:
+
+  def __init__(self, clqueue, maxHeldBlocks=64, maxHeldBytes=None):
+
+    self.pool = cltools.MemoryPool(cltools.ImmediateAllocator(clqueue))
+
+    # Free held blocks when either limit is exceeded, None disables a limit
+    self.maxHeldBlocks = maxHeldBlocks
+    self.maxHeldBytes = maxHeldBytes
+
+    # Statistics
+    self.hits = 0
+    self.misses = 0
+    self.trims = 0
+
+  def __call__(self, nbytes):
+    """Allocate buffer of nbytes, reusing a held block when possible"""
+
+    heldBlocks = self.pool.held_blocks
+
+    buf = self.pool.allocate(nbytes)
+
+    if self.pool.held_blocks < heldBlocks:
+      self.hits += 1
+    else:
+      self.misses += 1
+
+    if self._over_limits():
+      self.trim()
+
+    return buf
+
+  def held_bytes(self):
+    """Returns number of bytes held by the pool and not in use, or None if
+    not reported by this version of PyOpenCL"""
+    managed = getattr(self.pool, "managed_bytes", None)
+    active = getattr(self.pool, "active_bytes", None)
+    if managed is None or active is None:
+      return None
+    return managed - active
+
+  def trim(self):
+    """Release all held blocks back to the CL runtime"""
+    self.pool.free_held()
+    self.trims += 1
+
+  def stats(self):
+    """Returns dictionary of pool statistics"""
+    return {
+      "hits" : self.hits,
+      "misses" : self.misses,
+      "trims" : self.trims,
+      "heldBlocks" : self.pool.held_blocks,
+      "activeBlocks" : self.pool.active_blocks,
+      "heldBytes" : self.held_bytes(),
+      }
+
+  def _over_limits(self):
+    if self.maxHeldBlocks is not None and \
+        self.pool.held_blocks > self.maxHeldBlocks:
+      return True
+    if self.maxHeldBytes is not None:
+      heldBytes = self.held_bytes()
+      if heldBytes is not None and heldBytes > self.maxHeldBytes:
+        return True
+    return False
@@ -16,20 +16,29 @@
 # TODO:
 # - use volume node / vtkimage as inputs, only convert blocks to ImageCL
 #   as needed, make sure it can handle big images
-# - anchor merging, blend two affines if anchors are close together
-#   define objective function or use heuristic?
 
 from ImageCL import ImageCL
 from DeformationCL import DeformationCL
+from WeightCacheCL import WeightCacheCL
+from AnchorIndex import AnchorIndex
 
+import pyopencl as cl
 import pyopencl.array as cla
 
+import hashlib
+import math
 import numpy
 
 
 class PolyAffineCL:
 
   def __init__(self, fixedCL, movingCL):
+    # Kernels here read and write plain float buffers
+    for imgcl in (fixedCL, movingCL):
+      if imgcl.storage != "float":
+        raise ValueError("PolyAffineCL requires float storage, got " +
+          str(imgcl.storage))
+
     self.centers = []
     self.radii = []
     self.affines = []
@@ -37,6 +46,9 @@ class PolyAffineCL:
 
     self.fixedCL = fixedCL
 
+    # Shared CL device, all images and buffers live in its context
+    self.cldevice = fixedCL.cldevice
+
     self.origMovingCL = movingCL
     self.movingCL = movingCL
 
@@ -45,12 +57,98 @@ class PolyAffineCL:
     self.sum_weights = None
     self.weights = []
 
+    # Merge policy applied by add_affine, see merge_anchors. None disables
+    # a criterion
+    self.mergeMaxAnchors = None
+    self.mergeMinOverlap = None
+
+    # Reports of all merges done by add_affine since the last identity
+    self.mergeReports = []
+
+    # Spatial index over centers, kept in sync by the methods that change
+    # the list of centers
+    self.anchorIndex = AnchorIndex()
+
+    # Gaussian weight volumes computed by _get_weights, weightCache.stats()
+    # reports hits and misses
+    self.weightCache = WeightCacheCL()
+
     self.normalizeWeights = False
 
     self.convergenceRatio = 1e-4
 
     self.lineSearchIterations = 5
 
+    # Score all line search steps in one kernel launch, using a ladder of
+    # lineSearchIterations steps scaled by lineSearchRatio
+    self.batchedLineSearch = True
+    self.lineSearchRatio = 0.5
+
+    # Work group size of reduction kernels, must be a power of two
+    self.reductionGroupSize = 64
+
+    # Evaluate gradient terms of all affine components in a single pass over
+    # the volume instead of one pass per component ROI. Sampling always uses
+    # the single pass, which is the only one that reads the drawn samples
+    self.batchedGradient = True
+
+    # Gaussian weights beyond this many radii from an anchor are ignored.
+    # This truncates each weight with a step of exp(-0.5*cutoffRadii^2) of
+    # its peak on the cutoff ellipsoid, about 3.4e-4 at 4 radii (1.1% at 3),
+    # so culled results differ from the exhaustive sum by that much
+    self.cutoffRadii = 4.0
+
+    # Warp using per-tile lists of the affine components within cutoff
+    # radii, warpTileSize is the tile width in voxels. Tiles list every
+    # component reaching them, so there are no seams at tile borders, but
+    # the cutoff truncation above applies. When off, no cutoff is used by
+    # any kernel, see _get_cutoff
+    self.cullWarp = True
+    self.warpTileSize = 16
+
+    # Dense deformations from get_deformation, with grid as key, valid while
+    # the parameter signature is unchanged
+    self.deformations = { }
+    self.deformationSignature = None
+
+    # Device copies of the parameters, see _update_parameters
+    self.deviceParams = None
+    self.clorigins = { }
+    self.tileCache = None
+
+    # Output buffer reused by line search trials
+    self.trialCL = None
+
+    # Evaluate metric, gradient, and line search on a subset of voxels drawn
+    # at every iteration, sampleMode is "random" or "stratified". A fraction
+    # of one uses all voxels
+    self.sampleFraction = 1.0
+    self.sampleMode = "stratified"
+    self.sampleSeed = 0
+    self.random = numpy.random.RandomState(self.sampleSeed)
+
+    self.clsamples = None
+    self.numSamples = 0
+
+    # Full resolution iterations run by optimize after sampled iterations
+    self.polishIterations = 0
+
+    # Moving image is not updated by sampled iterations, see get_moving
+    self.movingDirty = False
+
+    # Coarse to fine schedule of optimize_pyramid, with image size reduced by
+    # each shrink factor along every axis. Convergence ratios of None use
+    # convergenceRatio
+    self.pyramidShrinkFactors = [4, 2, 1]
+    self.pyramidIterations = [10, 20, 5]
+    self.pyramidConvergenceRatios = None
+    self.pyramid = None
+    self.pyramidKey = None
+
+    # Optimizer with setup(polyAffine) and step(polyAffine) methods, e.g.
+    # PolyAffineLBFGS, None uses alternating gradient descent
+    self.optimizer = None
+
     # Optimizer state
     self.optimIter = 0
     self.optimMode = 0
@@ -65,6 +163,7 @@ class PolyAffineCL:
 
   def create_identity(self, number_per_axis=3):
     """Identity transform with equal number of affines at each axis"""
+    self.mergeReports = []
     self.centers = []
     self.radii = []
     self.affines = []
@@ -99,56 +198,53 @@ class PolyAffineCL:
           self.affines.append(A0)
           self.translations.append(T0)
 
+    self.anchorIndex.rebuild(self.centers, rad.min())
+
     print "Created identity with", len(self.affines), "affine transforms"
 
   def add_affine(self, A, T, C, r):
+    """Append an affine component and apply the merge policy. Returns list of
+    merge reports, see merge_anchors, also kept in mergeReports."""
     self.centers.append(C)
     self.radii.append(r)
     self.affines.append(A)
     self.translations.append(T)
 
+    if len(self.anchorIndex.points) == 0:
+      self.anchorIndex.cellSize = float(numpy.min(r))
+    self.anchorIndex.insert(C)
+
+    reports = []
+    if self.mergeMaxAnchors is not None or self.mergeMinOverlap is not None:
+      reports = self.merge_anchors(self.mergeMaxAnchors, self.mergeMinOverlap,
+        update=False)
+      self.mergeReports += reports
+
     if self.normalizeWeights:
       self.compute_weights_and_sum()
 
     self.movingCL = self.warp(self.origMovingCL,
       self.affines, self.translations, self.centers)
+    self.movingDirty = False
 
     # NOTE: need to reinitialize optimizer, either in here or outside
     #self.optimize_setup()
 
+    return reports
+
   def remove_affine(self, C, dist):
     """Erase affine transforms within a spherical ROI."""
 
-    numAffines = len(self.affines)
-
-    indices = []
-
-
-    """
-    # Erase all within ROI
-    for i in range(numAffines):
-      x = self.centers[i]
-
-      d = numpy.linalg.norm(x - C)
-
-      if d <= dist:
-        indices.append(i)
-    """
-
     # Erase only the closest within ROI
-    mindist = dist
-    for i in range(numAffines):
-      x = self.centers[i]
-
-      d = numpy.linalg.norm(x - C)
-
-      if d <= mindist:
-        indices = [i]
-        mindist = d
+    indices = []
+    i, d = self.anchorIndex.nearest(C, dist)
+    if i is not None:
+      indices = [i]
 
     print "Deleting affine components", indices
 
     for k in sorted(indices, reverse=True):
+      self.anchorIndex.remove(k)
       del self.affines[k]
       del self.translations[k]
       del self.centers[k]
@@ -159,6 +255,154 @@ class PolyAffineCL:
 
     self.movingCL = self.warp(self.origMovingCL,
       self.affines, self.translations, self.centers)
+    self.movingDirty = False
+
+  def merge_anchors(self, maxAnchors=None, minOverlap=None, update=True):
+    """
+    Merge pairs of affine components with strongly overlapping Gaussians
+    until there are at most maxAnchors components and no neighboring pair
+    overlaps by minOverlap or more (Bhattacharyya coefficient, 1 for equal
+    Gaussians). Parameters of a merged component are a least squares fit to
+    the displacement of the pair. Returns list of dictionaries reporting
+    merged centers and the RMS and maximum displacement error introduced.
+    If update is set, the moving image is warped with the new components.
+    """
+
+    reports = []
+
+    while len(self.centers) > 1:
+      i, j, overlap = self._most_overlapping_pair(minOverlap)
+      if i is None:
+        break
+
+      tooMany = maxAnchors is not None and len(self.centers) > maxAnchors
+      tooClose = minOverlap is not None and overlap >= minOverlap
+      if not tooMany and not tooClose:
+        break
+
+      A, T, C, r, rmsError, maxError = self._merge_pair(i, j)
+
+      reports.append({
+        "centers" : (self.centers[i], self.centers[j]),
+        "overlap" : overlap,
+        "rmsError" : rmsError,
+        "maxError" : maxError,
+        })
+
+      k, l = min(i, j), max(i, j)
+
+      self.affines[k] = A
+      self.translations[k] = T
+      self.centers[k] = C
+      self.radii[k] = r
+      self.anchorIndex.move(k, C)
+
+      del self.affines[l]
+      del self.translations[l]
+      del self.centers[l]
+      del self.radii[l]
+      self.anchorIndex.remove(l)
+
+    if update and len(reports) > 0:
+      if self.normalizeWeights:
+        self.compute_weights_and_sum()
+
+      self.movingCL = self.warp(self.origMovingCL,
+        self.affines, self.translations, self.centers)
+      self.movingDirty = False
+
+    return reports
+
+  @staticmethod
+  def gaussian_overlap(c1, r1, c2, r2):
+    """Bhattacharyya coefficient of two axis aligned Gaussians with centers
+    c and standard deviations r"""
+    v1 = numpy.asarray(r1, numpy.float64) ** 2
+    v2 = numpy.asarray(r2, numpy.float64) ** 2
+    v = 0.5 * (v1 + v2)
+    dc = numpy.asarray(c1, numpy.float64) - numpy.asarray(c2, numpy.float64)
+    distance = 0.125 * numpy.sum(dc*dc / v) + \
+      0.5 * numpy.sum(numpy.log(v / numpy.sqrt(v1 * v2)))
+    return math.exp(-distance)
+
+  def _most_overlapping_pair(self, minOverlap=None):
+    """Returns indices and overlap of the pair of components with largest
+    overlap. Every pair overlapping by minOverlap or more is compared, so the
+    result is exact when such a pair exists. Otherwise only nearest neighbors
+    are compared, a heuristic that can miss the best pair if radii differ."""
+
+    best = (None, None, -1.0)
+
+    # Overlap of at least minOverlap bounds center distance by the largest
+    # standard deviation, see gaussian_overlap
+    searchDist = 0.0
+    if minOverlap is not None and 0.0 < minOverlap < 1.0:
+      maxRadius = max([numpy.max(r) for r in self.radii])
+      searchDist = math.sqrt(-8.0 * math.log(minOverlap)) * maxRadius
+
+    for i in range(len(self.centers)):
+      neighbors = self.anchorIndex.knn(self.centers[i], 2)
+      if searchDist > 0.0:
+        neighbors += self.anchorIndex.radius(self.centers[i], searchDist)
+      for j in set([n[0] for n in neighbors]):
+        if j == i:
+          continue
+        overlap = PolyAffineCL.gaussian_overlap(
+          self.centers[i], self.radii[i], self.centers[j], self.radii[j])
+        if overlap > best[2]:
+          best = (i, j, overlap)
+
+    return best
+
+  def _merge_pair(self, i, j, samplesPerAxis=7):
+    """
+    Returns affine matrix, translation, center, and radii of a single
+    component approximating the displacement of components i and j, along
+    with the RMS and maximum displacement error at sample points.
+    """
+
+    indices = (i, j)
+
+    C = [numpy.asarray(self.centers[q], numpy.float64) for q in indices]
+    R = [numpy.asarray(self.radii[q], numpy.float64) for q in indices]
+
+    # Moment matching of the Gaussians, weighted by their volume
+    mass = numpy.array([numpy.prod(R[0]), numpy.prod(R[1])])
+    mass /= mass.sum()
+
+    newC = mass[0]*C[0] + mass[1]*C[1]
+    newR = numpy.sqrt(mass[0]*(R[0]**2 + (C[0]-newC)**2) +
+      mass[1]*(R[1]**2 + (C[1]-newC)**2))
+
+    # Sample points covering both components
+    lo = numpy.minimum(C[0] - 2.0*R[0], C[1] - 2.0*R[1])
+    hi = numpy.maximum(C[0] + 2.0*R[0], C[1] + 2.0*R[1])
+    axes = [numpy.linspace(lo[d], hi[d], samplesPerAxis) for d in range(3)]
+    grid = numpy.meshgrid(axes[0], axes[1], axes[2], indexing="ij")
+    X = numpy.column_stack([g.ravel() for g in grid])
+
+    # Displacement of the pair, as in add_affine_component
+    D = numpy.zeros(X.shape, numpy.float64)
+    for q, c, r in zip(indices, C, R):
+      w = numpy.exp(-0.5 * numpy.sum(((X - c) / r)**2, axis=1))
+      A = numpy.asarray(self.affines[q], numpy.float64)
+      T = numpy.asarray(self.translations[q], numpy.float64).ravel()
+      D += w[:,None] * (X.dot(A.T) + T)
+
+    # Fit w_new(x) * (A x + T) to the displacement
+    w = numpy.exp(-0.5 * numpy.sum(((X - newC) / newR)**2, axis=1))
+    M = w[:,None] * numpy.column_stack([X, numpy.ones((X.shape[0],))])
+    B = numpy.linalg.lstsq(M, D, rcond=-1)[0]
+
+    newA = B[0:3,:].T
+    newT = B[3,:]
+
+    E = M.dot(B) - D
+    errors = numpy.sqrt(numpy.sum(E*E, axis=1))
+
+    return (newA.astype(numpy.single), newT.astype(numpy.single),
+      newC.astype(numpy.single), newR.astype(numpy.single),
+      float(numpy.sqrt(numpy.mean(errors**2))), float(errors.max()))
 
   def optimize_setup(self):
     """Optimization setup, needs to be called before iterative calls to
@@ -177,15 +421,18 @@ class PolyAffineCL:
     if self.normalizeWeights:
       self.compute_weights_and_sum()
 
-    DiffFM = self.fixedCL.subtract(self.movingCL)
-    DiffFMSq = DiffFM.multiply(DiffFM)
-    errorL2 = DiffFMSq.sum()
+    self.random = numpy.random.RandomState(self.sampleSeed)
+
+    errorL2 = self.fixedCL.lazy().subtract(self.get_moving()).square().sum()
 
     self.currErrorL2 = errorL2
 
     self.refErrorL2 = errorL2
     print "Ref diff", self.refErrorL2
 
+    if self.optimizer is not None:
+      self.optimizer.setup(self)
+
   def compute_weights_and_sum(self):
 
     numTransforms = len(self.affines)
@@ -221,6 +468,17 @@ class PolyAffineCL:
 
     self.prevErrorL2 = self.currErrorL2
 
+    if self.is_sampling():
+      # Error of current parameters on the new samples
+      self.draw_samples()
+      self.currErrorL2 = self._ssd_steps([0.0])[0]
+      self.prevErrorL2 = self.currErrorL2
+
+    if self.optimizer is not None:
+      self.optimizer.step(self)
+      self.optimIter += 1
+      return
+
     print "Mode", self.optimMode
 
     # Alternating gradient descent with adaptive step sizes
@@ -257,6 +515,11 @@ class PolyAffineCL:
         max_dT = max(numpy.max(numpy.abs(dTList[q])), max_dT)
       self.stepT = 2.0 / max_dT
 
+    if self.batchedLineSearch or self.is_sampling():
+      print "Batched line search trans"
+      self.stepT = self._line_search_batched(self.stepT, dTList=dTList)
+      return
+
     print "Line search trans"
     for lineIter in range(self.lineSearchIterations):
       print "opt line iter", lineIter
@@ -265,11 +528,10 @@ class PolyAffineCL:
       for q in range(numTransforms):
         TTestList[q] = TList[q] - dTList[q]*self.stepT
 
-      M = self.warp(self.origMovingCL, self.affines, TTestList, self.centers)
+      M = self.warp(self.origMovingCL, self.affines, TTestList, self.centers,
+        self._get_trial_image())
 
-      DiffFM = self.fixedCL.subtract(M)
-      DiffFMSq = DiffFM.multiply(DiffFM)
-      errorL2Test = DiffFMSq.sum()
+      errorL2Test = self.fixedCL.lazy().subtract(M).square().sum()
 
       print "Test diff", errorL2Test
 
@@ -284,7 +546,7 @@ class PolyAffineCL:
 
         self.currErrorL2 = errorL2Test
 
-        self.movingCL = M
+        self._accept_trial(M)
 
         print "PolyAffine error=", self.currErrorL2
 
@@ -306,6 +568,11 @@ class PolyAffineCL:
         max_dA = max(numpy.max(numpy.abs(dAList[q])), max_dA)
       self.stepA = 0.1 / max_dA
 
+    if self.batchedLineSearch or self.is_sampling():
+      print "Batched line search affine"
+      self.stepA = self._line_search_batched(self.stepA, dAList=dAList)
+      return
+
     print "Line search affine"
     for lineIter in range(self.lineSearchIterations):
       print "opt line iter", lineIter
@@ -314,14 +581,10 @@ class PolyAffineCL:
       for q in range(numTransforms):
         ATestList[q] = AList[q] - dAList[q]*self.stepA
 
-      M = self.warp(self.origMovingCL, ATestList, self.translations, self.centers)
-
-      DiffFM = self.fixedCL.subtract(M)
-      DiffFMSq = DiffFM.multiply(DiffFM)
-      errorL2Test = DiffFMSq.sum()
+      M = self.warp(self.origMovingCL, ATestList, self.translations,
+        self.centers, self._get_trial_image())
 
-      del DiffFM
-      del DiffFMSq
+      errorL2Test = self.fixedCL.lazy().subtract(M).square().sum()
 
       print "Test diff", errorL2Test
 
@@ -336,7 +599,7 @@ class PolyAffineCL:
 
         self.currErrorL2 = errorL2Test
 
-        self.movingCL = M
+        self._accept_trial(M)
 
         print "PolyAffine error=", self.currErrorL2
 
@@ -358,6 +621,11 @@ class PolyAffineCL:
         max_dC = max(numpy.max(numpy.abs(dCList[q])), max_dC)
       self.stepC = 2.0 / max_dC
 
+    if self.batchedLineSearch or self.is_sampling():
+      print "Batched line search anchor"
+      self.stepC = self._line_search_batched(self.stepC, dCList=dCList)
+      return
+
     print "Line search anchor"
     for lineIter in range(self.lineSearchIterations):
       print "opt line iter", lineIter
@@ -366,14 +634,10 @@ class PolyAffineCL:
       for q in range(numTransforms):
         CTestList[q] = CList[q] - dCList[q]*self.stepC
 
-      M = self.warp(self.origMovingCL, self.affines, self.translations, CTestList)
-
-      DiffFM = self.fixedCL.subtract(M)
-      DiffFMSq = DiffFM.multiply(DiffFM)
-      errorL2Test = DiffFMSq.sum()
+      M = self.warp(self.origMovingCL, self.affines, self.translations,
+        CTestList, self._get_trial_image())
 
-      del DiffFM
-      del DiffFMSq
+      errorL2Test = self.fixedCL.lazy().subtract(M).square().sum()
 
       print "Test diff", errorL2Test
 
@@ -382,13 +646,13 @@ class PolyAffineCL:
 
         # TODO: figure out book-keeping, shouldn't have duplicates like this
         # gradient and warp should be aware of which to use
-        self.centers = CTestList
+        self._set_centers(CTestList)
 
         self.stepC *= 1.2
 
         self.currErrorL2 = errorL2Test
 
-        self.movingCL = M
+        self._accept_trial(M)
 
         print "PolyAffine error=", self.currErrorL2
 
@@ -397,6 +661,149 @@ class PolyAffineCL:
         self.stepC *= 0.5
 
 
+  def _line_search_batched(self, step, dAList=None, dTList=None, dCList=None):
+    """
+    Line search along the negative gradient directions dAList, dTList, and
+    dCList (None for parameters kept fixed) using a ladder of steps starting
+    at step/lineSearchRatio. Returns the step size for the next search.
+    """
+
+    numSteps = max(1, min(self.lineSearchIterations, 8))
+
+    steps = numpy.zeros((numSteps,), numpy.single)
+    for k in range(numSteps):
+      steps[k] = step * self.lineSearchRatio ** (k-1)
+
+    s = self.line_search_steps(steps, dAList, dTList, dCList)
+    if s is None:
+      return steps[-1] * self.lineSearchRatio
+
+    return s * 1.2
+
+  def _ssd_steps(self, steps, dAList=None, dTList=None, dCList=None):
+    """
+    Returns SSD of parameters P - s*dP for step sizes s in steps, computed
+    in a single kernel launch with one read back. When sampling, the SSD
+    over the samples is scaled to the number of voxels.
+    """
+
+    numTransforms = len(self.affines)
+
+    steps = numpy.array(steps, numpy.single)
+    numSteps = len(steps)
+
+    numRows = max(numTransforms, 1)
+    dA = numpy.zeros((numRows, 9), numpy.single)
+    dT = numpy.zeros((numRows, 3), numpy.single)
+    dC = numpy.zeros((numRows, 3), numpy.single)
+    for q in range(numTransforms):
+      if dAList is not None:
+        dA[q,:] = dAList[q].ravel()
+      if dTList is not None:
+        dT[q,:] = dTList[q].ravel()
+      if dCList is not None:
+        dC[q,:] = dCList[q].ravel()
+
+    F = self.fixedCL
+    M = self.origMovingCL
+
+    clqueue = F.clqueue
+
+    params = self._update_parameters(clqueue,
+      self.affines, self.translations, self.centers)
+
+    clorigin = self._get_origin(F)
+
+    cldA = cla.to_device(clqueue, dA)
+    cldT = cla.to_device(clqueue, dT)
+    cldC = cla.to_device(clqueue, dC)
+    clsteps = cla.to_device(clqueue, steps)
+
+    numVoxels = F.clarray.size
+    if self.is_sampling():
+      clsamples = self.clsamples
+      numSamples = self.numSamples
+      numItems = numSamples
+    else:
+      # Sample list is not read
+      clsamples = clsteps
+      numSamples = 0
+      numItems = numVoxels
+
+    groupSize = self.reductionGroupSize
+    numGroups = (numItems + groupSize - 1) / groupSize
+
+    clpartial = cla.empty(clqueue, (numGroups, numSteps), numpy.single)
+
+    F.clprogram.ssdPolyAffineSteps(clqueue,
+      (numGroups*groupSize,), (groupSize,),
+      F.clsize.data,
+      F.clarray.data, M.clarray.data,
+      F.clspacing.data, clorigin.data,
+      params["centers"].data, params["radii"].data,
+      params["matrices"].data, params["translations"].data,
+      cldC.data, cldA.data, cldT.data,
+      numpy.uint32(dCList is not None),
+      clsteps.data, numpy.uint32(numSteps),
+      numpy.uint32(numTransforms), numpy.float32(self._get_cutoff()),
+      clsamples.data, numpy.uint32(numSamples),
+      clpartial.data,
+      cl.LocalMemory(4*groupSize))
+
+    # Single read back for all trials
+    errors = clpartial.get().sum(axis=0, dtype=numpy.float64)
+
+    return errors * (float(numVoxels) / numItems)
+
+  def line_search_steps(self, steps, dAList=None, dTList=None, dCList=None):
+    """
+    Scores parameters P - s*dP for all step sizes s in steps (at most 8) in
+    a single kernel launch, dAList, dTList, and dCList are None for
+    parameters kept fixed. Updates parameters and moving image with the step
+    of lowest error if it improves on the current error. Returns accepted
+    step size or None.
+    """
+
+    numTransforms = len(self.affines)
+    if numTransforms == 0:
+      return None
+
+    steps = numpy.array(steps, numpy.single)[:8]
+
+    errors = self._ssd_steps(steps, dAList, dTList, dCList)
+
+    print "Test diffs", errors
+
+    best = int(numpy.argmin(errors))
+
+    if errors[best] >= self.currErrorL2:
+      return None
+
+    s = steps[best]
+    if dAList is not None:
+      self.affines = [self.affines[q] - dAList[q]*s
+        for q in range(numTransforms)]
+    if dTList is not None:
+      self.translations = [self.translations[q] - dTList[q]*s
+        for q in range(numTransforms)]
+    if dCList is not None:
+      self._set_centers([self.centers[q] - dCList[q]*s
+        for q in range(numTransforms)])
+
+    self.currErrorL2 = errors[best]
+
+    if self.is_sampling():
+      # Warp full moving image only when needed
+      self.movingDirty = True
+    else:
+      self._accept_trial(self.warp(self.origMovingCL,
+        self.affines, self.translations, self.centers,
+        self._get_trial_image()))
+
+    print "PolyAffine error=", self.currErrorL2
+
+    return s
+
   def optimize(self, maxIters=10):
     """Offline optimization of polyaffine parameters using adaptive step
     gradient descent."""
@@ -412,6 +819,135 @@ class PolyAffineCL:
 
       print "opt iter", iter, "steps", self.stepA, self.stepT, self.stepC
 
+    if self.is_sampling() and self.polishIterations > 0:
+      self.optimize_polish(self.polishIterations)
+
+  def optimize_polish(self, iterations):
+    """Full resolution iterations, e.g. to refine a sampled optimization"""
+
+    sampleFraction = self.sampleFraction
+    self.sampleFraction = 1.0
+
+    self.currErrorL2 = \
+      self.fixedCL.lazy().subtract(self.get_moving()).square().sum()
+
+    for iter in range(iterations):
+      self.optimize_step()
+
+    self.sampleFraction = sampleFraction
+
+  def optimize_pyramid(self):
+    """
+    Coarse to fine optimization over pyramidShrinkFactors levels, running
+    up to pyramidIterations steps per level. Parameters are in physical
+    units and carry over between levels unchanged.
+    """
+
+    fixedCL = self.fixedCL
+    origMovingCL = self.origMovingCL
+
+    pyramid = self.get_pyramid()
+
+    convergenceRatio = self.convergenceRatio
+
+    for level in range(len(pyramid)):
+      levelFixedCL, levelMovingCL = pyramid[level]
+
+      print "Pyramid level", level, "shape", levelFixedCL.shape
+
+      if self.pyramidConvergenceRatios is not None and \
+          self.pyramidConvergenceRatios[level] is not None:
+        self.convergenceRatio = self.pyramidConvergenceRatios[level]
+
+      self._set_images(levelFixedCL, levelMovingCL)
+      self.optimize(self.pyramidIterations[level])
+
+      self.convergenceRatio = convergenceRatio
+
+    if self.fixedCL is not fixedCL:
+      self._set_images(fixedCL, origMovingCL)
+      if self.normalizeWeights:
+        self.compute_weights_and_sum()
+
+  def get_pyramid(self):
+    """
+    Returns list of (fixed, moving) image pairs from coarse to fine, one
+    per shrink factor, smoothed before downsampling. Factor one uses the
+    full resolution images. Built once per pair of images and schedule.
+    """
+
+    key = (id(self.fixedCL), id(self.origMovingCL),
+      tuple(self.pyramidShrinkFactors))
+    if self.pyramid is not None and self.pyramidKey == key:
+      return self.pyramid
+
+    self.pyramid = []
+    for factor in self.pyramidShrinkFactors:
+      if factor <= 1:
+        self.pyramid.append((self.fixedCL, self.origMovingCL))
+        continue
+
+      shape = [max((n + factor - 1) / factor, 2) for n in self.fixedCL.shape]
+
+      # Anti-aliasing with standard deviation of half the new spacing
+      sigma = 0.5 * factor * min(self.fixedCL.spacing)
+
+      levelImages = []
+      for imgcl in (self.fixedCL, self.origMovingCL):
+        levelImages.append(imgcl.recursive_gaussian(sigma).resample(shape))
+
+      self.pyramid.append(tuple(levelImages))
+
+    self.pyramidKey = key
+
+    return self.pyramid
+
+  def _set_images(self, fixedCL, movingCL):
+    """Optimize using another pair of images, e.g. a pyramid level. The
+    moving image is warped with the current parameters when needed"""
+    self.fixedCL = fixedCL
+    self.origMovingCL = movingCL
+    self.movingCL = movingCL
+    self.movingDirty = True
+    self.trialCL = None
+
+  def is_sampling(self):
+    return self.sampleFraction < 1.0
+
+  def draw_samples(self):
+    """Draw sorted indices of the voxels used by the next iteration"""
+
+    numVoxels = self.fixedCL.clarray.size
+
+    if self.sampleMode == "random":
+      numSamples = max(int(numVoxels * self.sampleFraction), 1)
+      samples = numpy.unique(self.random.randint(0, numVoxels, numSamples))
+    elif self.sampleMode == "stratified":
+      # One voxel drawn from each run of stride consecutive voxels
+      stride = max(int(round(1.0 / self.sampleFraction)), 1)
+      samples = numpy.arange(0, numVoxels, stride)
+      samples += self.random.randint(0, stride, samples.size)
+      samples = numpy.minimum(samples, numVoxels-1)
+    else:
+      raise ValueError("Unknown sample mode " + self.sampleMode)
+
+    samples = samples.astype(numpy.uint32)
+
+    self.numSamples = samples.size
+    if self.clsamples is not None and self.clsamples.size >= samples.size:
+      cl.enqueue_copy(self.fixedCL.clqueue, self.clsamples.data, samples)
+    else:
+      self.clsamples = cla.to_device(self.fixedCL.clqueue, samples)
+
+  def get_moving(self):
+    """Returns moving image warped with the current parameters"""
+    if self.movingDirty:
+      self._accept_trial(self.warp(self.origMovingCL,
+        self.affines, self.translations, self.centers,
+        self._get_trial_image()))
+      self.movingDirty = False
+    return self.movingCL
+
   def gradient(self):
     """Gradient of L2 norm"""
 
@@ -423,8 +959,7 @@ class PolyAffineCL:
     gradC_list = []
     gradR_list = []
 
-    Phi = DeformationCL(self.fixedCL)
-    Phi.set_identity()
+    Phi = DeformationCL.get_identity(self.fixedCL)
 
     CoordCL = [Phi.hx, Phi.hy, Phi.hz]
 
@@ -435,13 +970,13 @@ class PolyAffineCL:
       T = self.translations[q]
 
       F = self.fixedCL.getROI(C, r)
-      M = self.movingCL.getROI(C, r)
+      M = self.get_moving().getROI(C, r)
 
       XList = []
       for d in range(3):
         XList.append(CoordCL[d].getROI(C, r))
 
-      DiffFM = F.subtract(M)
+      DiffFM = F.lazy().subtract(M)
 
       GList = M.gradient()
 
@@ -455,13 +990,12 @@ class PolyAffineCL:
       #W = self.weights[q]
       #W = self._get_weights(F.shape, C, r)
 
-      WD = W.multiply(DiffFM)
+      WD = W.lazy().multiply(DiffFM)
 
       gradA = numpy.zeros((3,3), dtype=numpy.single)
       for i in range(3):
         for j in range(3):
-          GX = GList[i].multiply(XList[j])
-          gradA[i,j] = -2.0 * WD.multiply(GX).sum()
+          gradA[i,j] = -2.0 * WD.multiply(GList[i]).multiply(XList[j]).sum()
 
       gradT = numpy.zeros((3,), dtype=numpy.single)
       for d in range(3):
@@ -498,8 +1032,8 @@ class PolyAffineCL:
         dot_AT_XR.add_inplace(AT.multiply(XR))
 
       for d in range(3):
-        gradC[d] = -WD.multiply(GList[d].multiply(dot_AT_XC)).sum()
-        gradR[d] = WD.multiply(GList[d].multiply(dot_AT_XR)).sum()
+        gradC[d] = -WD.multiply(GList[d]).multiply(dot_AT_XC).sum()
+        gradR[d] = WD.multiply(GList[d]).multiply(dot_AT_XR).sum()
 
       gradA_list.append(gradA)
       gradT_list.append(gradT)
@@ -509,17 +1043,22 @@ class PolyAffineCL:
 
     return gradA_list, gradT_list, gradC_list, gradR_list
 
-  def gradient_affine(self):
-    """Gradient of L2 norm for affine matrices only"""
-
-    numTransforms = len(self.centers)
+  def gradient_terms(self):
+    """
+    Gradient terms of L2 norm for all affine components. Returns list of
+    arrays with 9 affine, 3 translation, and 3 anchor terms. By default, and
+    always when sampling, terms are computed in one pass over the volume or
+    the drawn samples, see gradient_terms_all. With batchedGradient off,
+    each component uses one kernel launch and one read over its ROI of the
+    fully warped moving image.
+    """
 
-    gradA_list = []
+    if self.batchedGradient or self.is_sampling():
+      return list(self.gradient_terms_all())
 
-    Phi = DeformationCL(self.fixedCL)
-    Phi.set_identity()
+    numTransforms = len(self.centers)
 
-    CoordCL = [Phi.hx, Phi.hy, Phi.hz]
+    terms_list = []
 
     for q in range(numTransforms):
       C = self.centers[q]
@@ -528,15 +1067,7 @@ class PolyAffineCL:
       T = self.translations[q]
 
       F = self.fixedCL.getROI(C, r)
-      M = self.movingCL.getROI(C, r)
-
-      XList = []
-      for d in range(3):
-        XList.append(CoordCL[d].getROI(C, r))
-
-      DiffFM = F.subtract(M)
-
-      GList = M.gradient()
+      M = self.get_moving().getROI(C, r)
 
       CF = numpy.array(F.shape, dtype=numpy.single) / 2.0
 
@@ -545,208 +1076,540 @@ class PolyAffineCL:
       else:
         W = self._get_weights(F.shape, CF, r)
 
-      #W = self.weights[q]
-      #W = self._get_weights(F.shape, C, r)
+      terms_list.append(self._gradient_terms_roi(F, M, W, A, T, C, r))
 
-      WD = W.multiply(DiffFM)
+    return terms_list
 
-      gradA = numpy.zeros((3,3), dtype=numpy.single)
-      for i in range(3):
-        for j in range(3):
-          GX = GList[i].multiply(XList[j])
-          gradA[i,j] = -2.0 * WD.multiply(GX).sum()
-
-      gradA_list.append(gradA)
+  def gradient_terms_all(self):
+    """
+    Gradient terms of L2 norm for all affine components, computed in one
+    kernel launch over the full volume, or over the drawn samples when
+    sampling. Returns N x 15 array of terms.
 
-    return gradA_list
-      
-  def gradient_translation(self):
-    """Gradient of L2 norm for translations only"""
+    Unlike the per-ROI evaluation, weights are Gaussians centered at the
+    anchors and the moving image gradient is computed on the full volume.
+    """
 
     numTransforms = len(self.centers)
+    if numTransforms == 0:
+      return numpy.zeros((0, 15), dtype=numpy.single)
 
-    gradT_list = []
+    F = self.fixedCL
 
-    Phi = DeformationCL(self.fixedCL)
-    Phi.set_identity()
+    clqueue = F.clqueue
 
-    CoordCL = [Phi.hx, Phi.hy, Phi.hz]
+    params = self._update_parameters(clqueue,
+      self.affines, self.translations, self.centers)
 
-    for q in range(numTransforms):
-      C = self.centers[q]
-      r = self.radii[q]
-      A = self.affines[q]
-      T = self.translations[q]
+    clorigin = self._get_origin(F)
 
-      F = self.fixedCL.getROI(C, r)
-      M = self.movingCL.getROI(C, r)
+    if self.normalizeWeights:
+      clsumweights = self.sum_weights.clarray
+    else:
+      clsumweights = F.clarray
+
+    clterms = cla.zeros(clqueue, (numTransforms, 15), numpy.single)
+
+    if self.is_sampling():
+      groupSize = self.reductionGroupSize
+      numGroups = (self.numSamples + groupSize - 1) / groupSize
+
+      F.clprogram.gradientTermsPolyAffineSampled(clqueue,
+        (numGroups*groupSize,), (groupSize,),
+        F.clsize.data,
+        F.clarray.data, self.origMovingCL.clarray.data,
+        clsumweights.data, numpy.uint32(self.normalizeWeights),
+        F.clspacing.data, clorigin.data,
+        params["centers"].data, params["radii"].data,
+        params["matrices"].data, params["translations"].data,
+        numpy.uint32(numTransforms), numpy.float32(self._get_cutoff()),
+        self.clsamples.data, numpy.uint32(self.numSamples),
+        clterms.data,
+        cl.LocalMemory(4*groupSize))
+
+      # Scale sums over samples to the number of voxels
+      return clterms.get() * (float(F.clarray.size) / self.numSamples)
+
+    M = self.get_moving()
+
+    groupSize = self.reductionGroupSize
+    numGroups = (F.clarray.size + groupSize - 1) / groupSize
+
+    F.clprogram.gradientTermsPolyAffineAll(clqueue,
+      (numGroups*groupSize,), (groupSize,),
+      F.clsize.data,
+      F.clarray.data, M.clarray.data,
+      clsumweights.data, numpy.uint32(self.normalizeWeights),
+      F.clspacing.data, clorigin.data,
+      params["centers"].data, params["radii"].data,
+      params["matrices"].data, params["translations"].data,
+      numpy.uint32(numTransforms), numpy.float32(self._get_cutoff()),
+      clterms.data,
+      cl.LocalMemory(4*groupSize))
+
+    return clterms.get()
+
+  def normal_equations_all(self):
+    """
+    Gauss-Newton normal equations for the affine and translation parameters
+    of each affine component, computed in one kernel launch over the full
+    volume. Returns lists of 12x12 matrices J^T J and 12-vectors
+    J^T (fixed - moving), parameters ordered as in gradient_terms.
+    """
 
-      XList = []
-      for d in range(3):
-        XList.append(CoordCL[d].getROI(C, r))
+    numTransforms = len(self.centers)
+    if numTransforms == 0:
+      return [], []
 
-      DiffFM = F.subtract(M)
+    F = self.fixedCL
+    M = self.get_moving()
 
-      GList = M.gradient()
+    clqueue = F.clqueue
 
-      CF = numpy.array(F.shape, dtype=numpy.single) / 2.0
+    params = self._update_parameters(clqueue,
+      self.affines, self.translations, self.centers)
 
-      if self.normalizeWeights:
-        W = self.weights[q].divide(self.sum_weights.getROI(C, r))
-      else:
-        W = self._get_weights(F.shape, CF, r)
+    clorigin = self._get_origin(F)
 
-      #W = self.weights[q]
-      #W = self._get_weights(F.shape, C, r)
+    if self.normalizeWeights:
+      clsumweights = self.sum_weights.clarray
+    else:
+      clsumweights = F.clarray
 
-      WD = W.multiply(DiffFM)
+    clterms = cla.zeros(clqueue, (numTransforms, 90), numpy.single)
 
-      gradT = numpy.zeros((3,), dtype=numpy.single)
-      for d in range(3):
-        gradT[d] = -2.0 * WD.multiply(GList[d]).sum()
+    groupSize = self.reductionGroupSize
+    numGroups = (F.clarray.size + groupSize - 1) / groupSize
 
-      gradT_list.append(gradT)
+    F.clprogram.normalEquationsPolyAffineAll(clqueue,
+      (numGroups*groupSize,), (groupSize,),
+      F.clsize.data,
+      F.clarray.data, M.clarray.data,
+      clsumweights.data, numpy.uint32(self.normalizeWeights),
+      F.clspacing.data, clorigin.data,
+      params["centers"].data, params["radii"].data,
+      numpy.uint32(numTransforms), numpy.float32(self._get_cutoff()),
+      clterms.data,
+      cl.LocalMemory(4*groupSize))
+
+    terms = clterms.get().astype(numpy.float64)
 
+    upper = numpy.triu_indices(12)
+
+    JTJ_list = []
+    JTr_list = []
+    for q in range(numTransforms):
+      JTJ = numpy.zeros((12,12), numpy.float64)
+      JTJ[upper] = terms[q,0:78]
+      JTJ = JTJ + numpy.triu(JTJ, 1).T
+      JTJ_list.append(JTJ)
+      JTr_list.append(terms[q,78:90])
+
+    return JTJ_list, JTr_list
+
+  def gradient_affine(self):
+    """Gradient of L2 norm for affine matrices only"""
+    gradA_list = []
+    for terms in self.gradient_terms():
+      gradA_list.append(terms[0:9].reshape(3,3))
+    return gradA_list
+      
+  def gradient_translation(self):
+    """Gradient of L2 norm for translations only"""
+    gradT_list = []
+    for terms in self.gradient_terms():
+      gradT_list.append(terms[9:12])
     return gradT_list
 
   def gradient_anchor(self):
     """Gradient of L2 norm for anchor positions only"""
-
-    numTransforms = len(self.centers)
-
     gradC_list = []
+    for terms in self.gradient_terms():
+      gradC_list.append(terms[12:15])
+    return gradC_list
 
-    Phi = DeformationCL(self.fixedCL)
-    Phi.set_identity()
-
-    CoordCL = [Phi.hx, Phi.hy, Phi.hz]
+  def _gradient_terms_roi(self, F, M, W, A, T, C, r):
+    """Returns the 15 gradient terms accumulated over an ROI obtained
+    through getROI, coordinates are computed in the kernel"""
 
-    for q in range(numTransforms):
-      C = self.centers[q]
-      r = self.radii[q]
-      A = self.affines[q]
-      T = self.translations[q]
+    groupSize = self.reductionGroupSize
 
-      F = self.fixedCL.getROI(C, r)
-      M = self.movingCL.getROI(C, r)
+    numVoxels = F.clarray.size
+    numGroups = (numVoxels + groupSize - 1) / groupSize
 
-      XList = []
-      for d in range(3):
-        XList.append(CoordCL[d].getROI(C, r))
+    params = numpy.zeros((18,), dtype=numpy.single)
+    params[0:9] = A.ravel()
+    params[9:12] = T
+    params[12:15] = C
+    params[15:18] = r
 
-      DiffFM = F.subtract(M)
+    clparams = cla.to_device(F.clqueue, params)
+    clroiorigin = cla.to_device(F.clqueue,
+      numpy.array(F.roiOrigin, dtype=numpy.single))
 
-      GList = M.gradient()
+    clpartial = cla.empty(F.clqueue, (numGroups, 15), numpy.single)
 
-      CF = numpy.array(F.shape, dtype=numpy.single) / 2.0
+    F.clprogram.gradientTermsPolyAffine(F.clqueue,
+      (numGroups*groupSize,), (groupSize,),
+      F.clsize.data,
+      F.clarray.data, M.clarray.data, W.clarray.data,
+      F.clspacing.data, clroiorigin.data, clparams.data, clpartial.data,
+      cl.LocalMemory(4*groupSize))
 
-      if self.normalizeWeights:
-        W = self.weights[q].divide(self.sum_weights.getROI(C, r))
-      else:
-        W = self._get_weights(F.shape, CF, r)
+    # Sum partial results of the work groups on the host
+    terms = clpartial.get().sum(axis=0, dtype=numpy.float64)
 
-      #W = self.weights[q]
-      #W = self._get_weights(F.shape, C, r)
+    return terms.astype(numpy.single)
 
-      WD = W.multiply(DiffFM)
+  def applyTo(self, image):
+    """
+    Apply poly-affine transform to an image.
+    """
+    return self.warp(image, self.affines, self.translations, self.centers)
 
-      gradC = numpy.zeros((3,), dtype=numpy.single)
+  def get_deformation(self, image=None, gridShape=None):
+    """
+    Returns poly-affine transform as a dense DeformationCL on the grid of
+    image (fixedCL by default), so that several images can be warped with
+    one interpolation each. If gridShape is given the transform is
+    evaluated on a grid of that shape and its displacements upsampled with
+    trilinear interpolation. Results are cached until a parameter changes and are
+    shared, callers must not modify them.
+    """
 
-      dot_G_XC = F.clone()
-      dot_G_XC.fill(0.0)
+    if image is None:
+      image = self.fixedCL
 
-      ATList = []
+    signature = self.parameter_signature()
+    if signature != self.deformationSignature:
+      self.deformations = { }
+      self.deformationSignature = signature
 
-      for d in range(3):
-        AT = F.clone()
-        AT.fill(0.0)
-        for j in range(3):
-          Y = XList[d].clone()
-          Y.scale(A[d,j])
-          AT.add_inplace(Y)
-        AT.shift(T[d])
+    key = (tuple(image.shape), tuple(image.spacing), tuple(image.origin),
+      None if gridShape is None else tuple(gridShape))
+    if self.deformations.has_key(key):
+      return self.deformations[key]
 
-        ATList.append(AT)
+    if gridShape is None or list(gridShape) == list(image.shape):
+      deformation = self._compute_deformation(image)
+    else:
+      coarseCL = image.clone_empty()
+      coarseCL.shape = list(gridShape)
+      coarseCL.spacing = image.get_resampled_spacing(gridShape)
+      coarseCL.setup_geometry()
+      # Interpolation clamps at the last coarse samples, which holds
+      # displacements nearly constant but would freeze absolute coordinates
+      deformation = self._compute_deformation(coarseCL).to_displacement()
+      deformation = deformation.resample(image.shape).to_absolute()
+
+    self.deformations[key] = deformation
+
+    return deformation
+
+  def parameter_signature(self):
+    """Returns digest of all poly-affine parameters"""
+    sha = hashlib.sha1()
+    sha.update(str(len(self.affines)))
+    for plist in (self.affines, self.translations, self.centers, self.radii):
+      for x in plist:
+        sha.update(numpy.asarray(x, numpy.single).tostring())
+    return sha.hexdigest()
+
+  def _compute_deformation(self, gridCL):
+    """Evaluate mapped coordinates on the grid of gridCL"""
 
-        XC = XList[d].clone()
-        XC.shift(-C[d])
-        XC.scale(2.0 / r[d]**2)
+    numTransforms = len(self.affines)
 
-        dot_G_XC.add_inplace(GList[d].multiply(XC))
+    params = self._update_parameters(gridCL.clqueue,
+      self.affines, self.translations, self.centers)
 
-      for d in range(3):
-        gradC[d] = -WD.multiply(ATList[d].multiply(dot_G_XC)).sum()
+    clorigin = self._get_origin(gridCL)
 
-      gradC_list.append(gradC)
+    hlist = []
+    for dim in range(3):
+      h = gridCL.clone_empty()
+      h.clarray = cla.empty(gridCL.clqueue, tuple(gridCL.shape), numpy.single)
+      hlist.append(h)
+
+    if self.cullWarp and numTransforms > 0:
+      clnumtiles, cltileoffsets, cltileindices = self._get_tiles_cl(gridCL,
+        params["hostCenters"], params["hostRadii"])
+      tileSize = self.warpTileSize
+    else:
+      # Tile arrays are not read
+      clnumtiles = cltileoffsets = cltileindices = clorigin
+      tileSize = 0
+    cutoff = self._get_cutoff()
+
+    gridCL.clprogram.polyAffineDeformation(gridCL.clqueue, gridCL.shape, None,
+      gridCL.clsize.data,
+      params["centers"].data, params["radii"].data,
+      params["matrices"].data, params["translations"].data,
+      numpy.uint32(numTransforms),
+      numpy.uint32(tileSize), clnumtiles.data,
+      cltileoffsets.data, cltileindices.data,
+      numpy.float32(cutoff),
+      gridCL.clspacing.data, clorigin.data,
+      hlist[0].clarray.data, hlist[1].clarray.data, hlist[2].clarray.data)
 
-    return gradC_list
+    return DeformationCL(hlist[0], hlist)
 
-  def applyTo(self, image):
+  def warp(self, image, AList, TList, CList, out=None):
     """
-    Apply poly-affine transform to an image.
+    Compute deformation field and update moving image.
+    Returns warped version of image with the given poly-affine parameters,
+    written to out if given or to a new ImageCL object otherwise.
     """
-    return self.warp(image, self.affines, self.translations, self.centers)
 
-  def warp(self, image, AList, TList, CList):
+    numTransforms = len(AList)
+
+    params = self._update_parameters(image.clqueue, AList, TList, CList)
+
+    clorigin = self._get_origin(image)
+
+    if out is None:
+      out = image.clone_empty()
+      out.clarray = cla.empty_like(image.clarray)
+
+    if self.cullWarp and numTransforms > 0:
+      clnumtiles, cltileoffsets, cltileindices = self._get_tiles_cl(image,
+        params["hostCenters"], params["hostRadii"])
+
+      image.clprogram.applyPolyAffineTiled(image.clqueue, image.shape, None,
+        image.clsize.data,
+        params["centers"].data, params["radii"].data,
+        params["matrices"].data, params["translations"].data,
+        numpy.uint32(self.warpTileSize), clnumtiles.data,
+        cltileoffsets.data, cltileindices.data,
+        numpy.float32(self.cutoffRadii),
+        image.clarray.data, image.clspacing.data, clorigin.data,
+        out.clarray.data)
+    else:
+      image.clprogram.applyPolyAffine(image.clqueue, image.shape, None,
+        image.clsize.data,
+        params["centers"].data, params["radii"].data,
+        params["matrices"].data, params["translations"].data,
+        numpy.uint32(numTransforms),
+        image.clarray.data, image.clspacing.data, clorigin.data,
+        out.clarray.data)
+
+    return out
+
+  def _get_trial_image(self):
+    """Returns output buffer for a line search trial, never the current or
+    original moving image"""
+    if self.trialCL is None or self.trialCL is self.movingCL or \
+        self.trialCL is self.origMovingCL or \
+        self.trialCL.shape != self.origMovingCL.shape:
+      self.trialCL = self.origMovingCL.clone_empty()
+      self.trialCL.clarray = cla.empty_like(self.origMovingCL.clarray)
+    return self.trialCL
+
+  def _accept_trial(self, M):
+    """Make trial output the moving image, previous moving image buffer is
+    recycled for the next trial"""
+    prevMovingCL = self.movingCL
+    self.movingCL = M
+    if prevMovingCL is self.origMovingCL:
+      self.trialCL = None
+    else:
+      self.trialCL = prevMovingCL
+
+  def _update_parameters(self, clqueue, AList, TList, CList):
     """
-    Compute deformation field and update moving image.
-    Returns warped version of origMovingCL with current poly-affine parameters.
+    Update device copies of the parameters, stored as arrays of matrices,
+    centers, translations, and radii with one row per affine component.
+    Only rows that differ from the previous update are uploaded. Returns
+    dictionary with the device arrays and host arrays of centers and radii.
     """
 
     numTransforms = len(AList)
 
-    shape = self.fixedCL.shape
+    names = ["matrices", "centers", "translations", "radii"]
+    widths = [9, 3, 3, 3]
+    lists = [AList, CList, TList, self.radii]
 
-    A = numpy.zeros((numTransforms, 3*3), numpy.single)
-    C = numpy.zeros((numTransforms, 3), numpy.single)
-    T = numpy.zeros((numTransforms, 3), numpy.single)
-    R = numpy.zeros((numTransforms, 3), numpy.single)
+    params = self.deviceParams
 
-    for i in range(numTransforms):
-      A[i,:] = AList[i].ravel()
-      C[i,:] = CList[i].ravel()
-      T[i,:] = TList[i] .ravel()
-      R[i,:] = self.radii[i].ravel()
+    if params is None or params["capacity"] < numTransforms:
+      # Grow storage, NaN host rows force upload of all rows
+      capacity = 8
+      if params is not None:
+        capacity = params["capacity"]
+      while capacity < numTransforms:
+        capacity *= 2
 
-    clmatrices = cla.to_device(image.clqueue, A)
-    clcenters = cla.to_device(image.clqueue, C)
-    cltrans = cla.to_device(image.clqueue, T)
-    clradii = cla.to_device(image.clqueue, R)
+      params = {"capacity" : capacity}
+      for name, width in zip(names, widths):
+        params["host_" + name] = numpy.empty((capacity, width), numpy.single)
+        params["host_" + name].fill(numpy.nan)
+        params[name] = cla.empty(clqueue, (capacity, width), numpy.single)
 
-    clorigin = cla.to_device(image.clqueue, numpy.array(image.origin))
+      self.deviceParams = params
 
-    warpedImage = image.clone()
+    for name, width, plist in zip(names, widths, lists):
+      host = params["host_" + name]
+      clarr = params[name]
 
-    image.clprogram.applyPolyAffine(image.clqueue, image.shape, None,
-      clcenters.data, clradii.data, clmatrices.data, cltrans.data,
-      numpy.uint32(numTransforms),
-      image.clarray.data, image.clspacing.data, clorigin.data,
-      warpedImage.clarray.data)
+      if numTransforms == 0:
+        continue
+
+      rows = numpy.array([numpy.ravel(x) for x in plist[:numTransforms]],
+        dtype=numpy.single).reshape(numTransforms, width)
+
+      changed = numpy.nonzero(
+        numpy.any(host[:numTransforms] != rows, axis=1))[0]
+      if len(changed) == 0:
+        continue
+
+      host[:numTransforms] = rows
+
+      rowBytes = width * host.itemsize
+      if 2*len(changed) > numTransforms:
+        # Most rows changed, upload as one block
+        cl.enqueue_copy(clqueue, clarr.data, host[:numTransforms])
+      else:
+        for i in changed:
+          cl.enqueue_copy(clqueue, clarr.data, host[i],
+            device_offset=int(i)*rowBytes)
+
+    params["hostCenters"] = params["host_centers"][:numTransforms]
+    params["hostRadii"] = params["host_radii"][:numTransforms]
+
+    return params
+
+  def _get_cutoff(self):
+    """Returns cutoff in radii for all kernels, infinite when the warp is
+    not culled so that optimization and warp use the same transform"""
+    if self.cullWarp:
+      return self.cutoffRadii
+    return float('Inf')
+
+  def _get_origin(self, image):
+    """Returns device copy of image origin, uploaded once per origin"""
+    key = tuple(image.origin)
+    if not self.clorigins.has_key(key):
+      self.clorigins[key] = cla.to_device(image.clqueue,
+        numpy.array(image.origin, numpy.single))
+    return self.clorigins[key]
+
+  def _get_tiles_cl(self, image, C, R):
+    """Returns device arrays from _get_tiles, rebuilt only when the image
+    geometry, anchors, or radii change"""
+
+    key = (tuple(image.shape), tuple(image.origin), tuple(image.spacing),
+      self.warpTileSize, self.cutoffRadii, C.tostring(), R.tostring())
+
+    if self.tileCache is None or self.tileCache[0] != key:
+      numTiles, tileOffsets, tileIndices = self._get_tiles(image, C, R)
+      self.tileCache = (key,
+        cla.to_device(image.clqueue, numTiles),
+        cla.to_device(image.clqueue, tileOffsets),
+        cla.to_device(image.clqueue, tileIndices))
+
+    return self.tileCache[1:]
+
+  def _get_tiles(self, image, C, R):
+    """
+    Bin affine components into tiles of warpTileSize^3 voxels. A component
+    is listed in every tile overlapping the box within cutoffRadii radii of
+    its anchor. Returns number of tiles per axis, and tile offsets and
+    component indices in compressed row format.
+    """
+
+    tileSize = self.warpTileSize
 
-    return warpedImage
+    numTiles = numpy.zeros((3,), numpy.uint32)
+    for d in range(3):
+      numTiles[d] = (image.shape[d] + tileSize - 1) / tileSize
+
+    tileLists = [[] for t in range(int(numpy.prod(numTiles)))]
+
+    for i in range(C.shape[0]):
+      t0 = [0, 0, 0]
+      t1 = [0, 0, 0]
+      for d in range(3):
+        p0 = (C[i,d] - self.cutoffRadii*R[i,d] - image.origin[d]) / image.spacing[d]
+        p1 = (C[i,d] + self.cutoffRadii*R[i,d] - image.origin[d]) / image.spacing[d]
+        t0[d] = max(0, int(numpy.floor(p0)) / tileSize)
+        t1[d] = min(int(numTiles[d])-1, int(numpy.ceil(p1)) / tileSize)
+
+      for tx in range(t0[0], t1[0]+1):
+        for ty in range(t0[1], t1[1]+1):
+          for tz in range(t0[2], t1[2]+1):
+            tile = (tx*numTiles[1] + ty)*numTiles[2] + tz
+            tileLists[tile].append(i)
+
+    tileOffsets = numpy.zeros((len(tileLists)+1,), numpy.uint32)
+    for t in range(len(tileLists)):
+      tileOffsets[t+1] = tileOffsets[t] + len(tileLists[t])
+
+    tileIndices = numpy.zeros((max(int(tileOffsets[-1]), 1),), numpy.uint32)
+    for t in range(len(tileLists)):
+      tileIndices[tileOffsets[t]:tileOffsets[t+1]] = tileLists[t]
+
+    return numTiles, tileOffsets, tileIndices
+
+  def _set_centers(self, CList):
+    """Replace anchors and update the anchor index"""
+    if len(CList) != len(self.centers):
+      self.centers = CList
+      self.anchorIndex.rebuild(CList)
+      return
+
+    for q in range(len(self.centers)):
+      if numpy.any(self.centers[q] != CList[q]):
+        self.anchorIndex.move(q, CList[q])
+    self.centers = CList
+
+  def nearest_anchor(self, x, maxDist=float('Inf')):
+    """Returns index of the anchor closest to x within maxDist and its
+    distance, or None and infinity"""
+    return self.anchorIndex.nearest(x, maxDist)
+
+  def anchors_within(self, x, dist):
+    """Returns list of (index, distance) of anchors within dist of x"""
+    return self.anchorIndex.radius(x, dist)
+
+  def nearest_anchors(self, x, k):
+    """Returns list of (index, distance) of the k anchors closest to x"""
+    return self.anchorIndex.knn(x, k)
 
   def _get_weights(self, shape, center, radii):
-    """Returns ImageCL object of Gaussian weights"""
+    """Returns ImageCL object of Gaussian weights, shared through the weight
+    cache and not to be modified"""
 
-    weightsCL = ImageCL(self.fixedCL.preferredDeviceType)
-    temparr = numpy.zeros(shape, dtype=numpy.single)
-    weightsCL.fromArray(temparr, self.fixedCL.origin, self.fixedCL.spacing) 
+    fixedCL = self.fixedCL
+
+    key = WeightCacheCL.get_key(shape, center, radii,
+      fixedCL.spacing, fixedCL.origin)
+
+    def builder():
+      weightsCL = ImageCL(fixedCL.preferredDeviceType)
+      weightsCL.shape = list(shape)
+      weightsCL.origin = list(fixedCL.origin)
+      weightsCL.spacing = list(fixedCL.spacing)
+      weightsCL.setup()
+      weightsCL.setup_geometry()
 
-    clcenter = cla.to_device(weightsCL.clqueue,
-      numpy.array(center) )
+      weightsCL.clarray = cla.empty(weightsCL.clqueue, tuple(shape),
+        numpy.single, allocator=weightsCL.cldevice.allocator)
 
-    clorigin = cla.to_device(weightsCL.clqueue,
-      numpy.array(self.fixedCL.origin) )
+      clcenter = cla.to_device(weightsCL.clqueue,
+        numpy.array(center, numpy.single))
+      clradii = cla.to_device(weightsCL.clqueue,
+        numpy.array(radii, numpy.single))
 
-    clradii = cla.to_device(weightsCL.clqueue, radii)
+      weightsCL.clprogram.weightsPolyAffine(
+        weightsCL.clqueue, shape, None,
+        weightsCL.clsize.data,
+        clcenter.data, clradii.data,
+        weightsCL.clspacing.data, self._get_origin(fixedCL).data,
+        weightsCL.clarray.data)
 
-    weightsCL.clprogram.weightsPolyAffine(
-      weightsCL.clqueue, shape, None,
-      clcenter.data, clradii.data,
-      weightsCL.clspacing.data, clorigin.data,
-      weightsCL.clarray.data)
+      return weightsCL
 
-    return weightsCL
+    return self.weightCache.get(key, builder)
 
     """
     origin = numpy.array(center, dtype=numpy.single)
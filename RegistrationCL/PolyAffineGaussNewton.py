@@ -0,0 +1,66 @@
+#
+# PolyAffineGaussNewton: Gauss-Newton optimizer for PolyAffineCL
+#
+# Solves damped 12x12 normal equations for the affine matrix and translation
+# of each affine component, ignoring coupling between components. The
+# normal equations of all components are built on the device in one pass
+# over the volume (PolyAffineCL.normal_equations_all).
+#
+# Usage:
+#   polyAffine.optimizer = PolyAffineGaussNewton()
+#   polyAffine.optimize(maxIters)
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+from PolyAffineOptimizer import PolyAffineOptimizer
+
+import numpy
+
+class PolyAffineGaussNewton(PolyAffineOptimizer):
+
+  def __init__(self, damping=1e-3):
+    PolyAffineOptimizer.__init__(self)
+
+    # Levenberg-Marquardt damping, relative to the diagonal of J^T J
+    self.initialDamping = damping
+    self.damping = damping
+    self.minDamping = 1e-6
+    self.maxDamping = 1e6
+
+    # Step sizes tried along each Gauss-Newton direction
+    self.steps = [1.0, 0.5, 0.25, 0.125, 0.0625]
+
+  def reset(self):
+    self.damping = self.initialDamping
+
+  def update(self, polyAffine):
+
+    JTJ_list, JTr_list = polyAffine.normal_equations_all()
+
+    dAList = []
+    dTList = []
+
+    for q in range(len(JTJ_list)):
+      JTJ = JTJ_list[q]
+      H = JTJ + self.damping * numpy.diag(numpy.diag(JTJ))
+      H += 1e-12 * max(numpy.trace(JTJ), 1.0) * numpy.eye(12)
+
+      try:
+        delta = numpy.linalg.solve(H, JTr_list[q])
+      except numpy.linalg.LinAlgError:
+        delta = numpy.linalg.lstsq(H, JTr_list[q], rcond=-1)[0]
+
+      # Line search moves parameters by -step*dP
+      dAList.append(-delta[0:9].reshape(3,3).astype(numpy.single))
+      dTList.append(-delta[9:12].astype(numpy.single))
+
+    print "Gauss-Newton step, damping", self.damping
+
+    step = polyAffine.line_search_steps(self.steps,
+      dAList=dAList, dTList=dTList)
+
+    if step is None:
+      self.damping = min(self.damping * 4.0, self.maxDamping)
+    elif step >= self.steps[0]:
+      self.damping = max(self.damping * 0.5, self.minDamping)
@@ -0,0 +1,94 @@
+#
+# PolyAffineLBFGS: limited memory BFGS optimizer for PolyAffineCL
+#
+# Quasi-Newton updates of the affine matrices and translations of all
+# affine components, using the batched line search of PolyAffineCL to try
+# several step sizes along each search direction in one kernel launch.
+#
+# Usage:
+#   polyAffine.optimizer = PolyAffineLBFGS()
+#   polyAffine.optimize(maxIters)
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+from PolyAffineOptimizer import PolyAffineOptimizer
+
+import numpy
+
+class PolyAffineLBFGS(PolyAffineOptimizer):
+
+  def __init__(self, memory=5):
+    PolyAffineOptimizer.__init__(self)
+
+    # Number of correction pairs kept
+    self.memory = memory
+
+    # Largest parameter change of the first, steepest descent, step
+    self.initialStep = 2.0
+
+    # Step sizes tried along each search direction
+    self.steps = [2.0, 1.0, 0.5, 0.25, 0.125, 0.0625]
+
+    self.reset()
+
+  def reset(self):
+    self.sList = []
+    self.yList = []
+    self.prevX = None
+    self.prevG = None
+
+  def update(self, polyAffine):
+
+    x = self.get_parameters(polyAffine)
+    g = self.get_gradient(polyAffine)
+
+    if self.prevX is not None:
+      s = x - self.prevX
+      y = g - self.prevG
+      # Skip pairs that would make the inverse Hessian estimate indefinite
+      if numpy.dot(s, y) > 1e-10 * numpy.dot(y, y):
+        self.sList.append(s)
+        self.yList.append(y)
+        if len(self.sList) > self.memory:
+          del self.sList[0]
+          del self.yList[0]
+
+    d = -self._apply_inverse_hessian(g)
+
+    if len(self.sList) == 0:
+      d *= self.initialStep / max(numpy.max(numpy.abs(g)), 1e-10)
+
+    step = self.line_search(polyAffine, d, self.steps)
+
+    if step is None:
+      # Restart from steepest descent
+      self.reset()
+    else:
+      self.prevX = x
+      self.prevG = g
+
+  def _apply_inverse_hessian(self, g):
+    """Two-loop recursion"""
+
+    q = g.copy()
+
+    numPairs = len(self.sList)
+    alpha = numpy.zeros((numPairs,), numpy.float64)
+    rho = numpy.zeros((numPairs,), numpy.float64)
+
+    for i in reversed(range(numPairs)):
+      rho[i] = 1.0 / numpy.dot(self.yList[i], self.sList[i])
+      alpha[i] = rho[i] * numpy.dot(self.sList[i], q)
+      q -= alpha[i] * self.yList[i]
+
+    if numPairs > 0:
+      s = self.sList[-1]
+      y = self.yList[-1]
+      q *= numpy.dot(s, y) / numpy.dot(y, y)
+
+    for i in range(numPairs):
+      beta = rho[i] * numpy.dot(self.yList[i], q)
+      q += (alpha[i] - beta) * self.sList[i]
+
+    return q
@@ -0,0 +1,110 @@
+#
+# PolyAffineOptimizer: base class of optimizers for PolyAffineCL parameters
+#
+# Assign an instance to PolyAffineCL.optimizer to replace the alternating
+# gradient descent. setup() is called by optimize_setup and step() by
+# optimize_step. Subclasses override update(), which changes the affine
+# matrices and translations and the moving image through
+# PolyAffineCL.line_search_steps, and reset(), which clears optimizer state.
+# The base class keeps all parameters fixed.
+#
+# Anchors are still updated by the gradient descent step of PolyAffineCL
+# every anchorInterval iterations.
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+import numpy
+
+class PolyAffineOptimizer:
+
+  def __init__(self):
+
+    # Update anchors every this many iterations, zero keeps anchors fixed
+    self.anchorInterval = 5
+
+    # Affine parameters are multiplied by this length (mean radius of the
+    # affine components by default) so that they are in the same units as
+    # translations
+    self.lengthScale = None
+
+    # Number of updates done since setup
+    self.numUpdates = 0
+
+  def setup(self, polyAffine):
+    """Called by PolyAffineCL.optimize_setup"""
+    self.numUpdates = 0
+    if len(polyAffine.radii) > 0:
+      self.lengthScale = float(numpy.mean(numpy.array(polyAffine.radii)))
+    else:
+      self.lengthScale = 1.0
+    self.reset()
+
+  def step(self, polyAffine):
+    """Called by PolyAffineCL.optimize_step"""
+
+    if self.anchorInterval > 0 and polyAffine.optimIter > 1 and \
+        (polyAffine.optimIter % self.anchorInterval) == 0:
+      polyAffine.optimize_anchors()
+      if polyAffine.normalizeWeights:
+        polyAffine.compute_weights_and_sum()
+      # Curvature information is no longer valid after moving anchors
+      self.reset()
+      return
+
+    self.update(polyAffine)
+    self.numUpdates += 1
+
+  def reset(self):
+    """Clear optimizer state"""
+    pass
+
+  def update(self, polyAffine):
+    """Update affine matrices and translations, nothing by default"""
+    pass
+
+  #
+  # Parameter vector with 9 scaled affine and 3 translation entries per
+  # affine component
+  #
+
+  def get_parameters(self, polyAffine):
+    x = numpy.zeros((len(polyAffine.affines), 12), numpy.float64)
+    for q in range(len(polyAffine.affines)):
+      x[q,0:9] = polyAffine.affines[q].ravel() * self.lengthScale
+      x[q,9:12] = polyAffine.translations[q].ravel()
+    return x.ravel()
+
+  def set_parameters(self, polyAffine, x):
+    """Set affine matrices and translations from a parameter vector, does
+    not warp the moving image"""
+    dAList, dTList = self.get_direction_lists(x)
+    polyAffine.affines = dAList
+    polyAffine.translations = dTList
+
+  def get_gradient(self, polyAffine):
+    """Gradient of L2 norm with respect to the parameter vector"""
+    terms = polyAffine.gradient_terms()
+    g = numpy.zeros((len(terms), 12), numpy.float64)
+    for q in range(len(terms)):
+      g[q,0:9] = terms[q][0:9] / self.lengthScale
+      g[q,9:12] = terms[q][9:12]
+    return g.ravel()
+
+  def get_direction_lists(self, d):
+    """Returns lists of affine and translation changes for a change d of
+    the parameter vector"""
+    d = d.reshape(-1, 12)
+    dAList = []
+    dTList = []
+    for q in range(d.shape[0]):
+      dAList.append(
+        (d[q,0:9] / self.lengthScale).reshape(3,3).astype(numpy.single))
+      dTList.append(d[q,9:12].astype(numpy.single))
+    return dAList, dTList
+
+  def line_search(self, polyAffine, d, steps):
+    """Try steps along direction d of the parameter vector, returns accepted
+    step or None"""
+    dAList, dTList = self.get_direction_lists(-d)
+    return polyAffine.line_search_steps(steps, dAList=dAList, dTList=dTList)
@@ -0,0 +1,164 @@
+#
+# ProgramCache: persistent on-disk cache of compiled CL program binaries
+#
+# Binaries are keyed by device name, driver version, program source, and
+# build options, and stored in a user cache directory. The cache is bounded
+# in size, least recently used binaries are evicted first. Binaries rejected
+# by the CL runtime are discarded and the program is built from source.
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+import pyopencl as cl
+
+import hashlib
+import os
+import tempfile
+
+class ProgramCache:
+
+  def __init__(self, cacheDir=None, maxBytes=64*1024*1024):
+
+    if cacheDir is None:
+      cacheDir = ProgramCache.default_cache_dir()
+
+    self.cacheDir = cacheDir
+    self.maxBytes = maxBytes
+
+    # Statistics
+    self.binaryLoads = 0
+    self.sourceBuilds = 0
+    self.rejectedBinaries = 0
+
+  @staticmethod
+  def default_cache_dir():
+    """Returns per-user cache directory for CL program binaries"""
+    if os.name == "nt":
+      baseDir = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+      baseDir = os.environ.get("XDG_CACHE_HOME",
+        os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(baseDir, "SteeredRegistrationCL", "programs")
+
+  def get_key(self, device, source, options=""):
+    """Cache key for a program built for a single device"""
+    h = hashlib.sha1()
+    h.update(device.name.strip())
+    h.update(device.platform.name.strip())
+    h.update(device.driver_version.strip())
+    h.update(device.version.strip())
+    h.update(source)
+    h.update(options)
+    return h.hexdigest()
+
+  def build(self, context, source, options=""):
+    """Returns CL program built from cached binaries when available,
+    otherwise builds from source and stores the binaries."""
+
+    devices = context.devices
+
+    keys = [self.get_key(device, source, options) for device in devices]
+
+    binaries = self._load(keys)
+
+    if binaries is not None:
+      try:
+        program = cl.Program(context, devices, binaries).build(options)
+        self.binaryLoads += 1
+        return program
+      except cl.Error, e:
+        print "WARNING: cached CL program binary rejected, building source"
+        self.rejectedBinaries += 1
+        self._remove(keys)
+
+    program = cl.Program(context, source).build(options)
+    self.sourceBuilds += 1
+
+    try:
+      self._store(keys, program.get_info(cl.program_info.BINARIES))
+    except (cl.Error, EnvironmentError), e:
+      print "WARNING: unable to store CL program binary:", e
+
+    return program
+
+  def clear(self):
+    """Remove all cached binaries"""
+    for path, size, mtime in self._list_entries():
+      self._remove_file(path)
+
+  def _path(self, key):
+    return os.path.join(self.cacheDir, key + ".bin")
+
+  def _load(self, keys):
+    binaries = []
+    for key in keys:
+      path = self._path(key)
+      if not os.path.isfile(path):
+        return None
+      try:
+        fp = open(path, "rb")
+        binaries.append(fp.read())
+        fp.close()
+        # Update modification time for least recently used eviction
+        os.utime(path, None)
+      except EnvironmentError:
+        return None
+      if len(binaries[-1]) == 0:
+        return None
+    return binaries
+
+  def _store(self, keys, binaries):
+    if not os.path.isdir(self.cacheDir):
+      os.makedirs(self.cacheDir)
+
+    for key, binary in zip(keys, binaries):
+      if binary is None or len(binary) == 0:
+        continue
+      # Write to temporary file and rename so that concurrent sessions never
+      # read a partially written binary
+      fd, tempPath = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+      fp = os.fdopen(fd, "wb")
+      fp.write(binary)
+      fp.close()
+      path = self._path(key)
+      if os.name == "nt" and os.path.exists(path):
+        self._remove_file(path)
+      os.rename(tempPath, path)
+
+    self._evict()
+
+  def _remove(self, keys):
+    for key in keys:
+      self._remove_file(self._path(key))
+
+  def _remove_file(self, path):
+    try:
+      os.remove(path)
+    except EnvironmentError:
+      pass
+
+  def _list_entries(self):
+    """Returns list of (path, size, mtime) of cached binaries"""
+    entries = []
+    if not os.path.isdir(self.cacheDir):
+      return entries
+    for name in os.listdir(self.cacheDir):
+      if not name.endswith(".bin"):
+        continue
+      path = os.path.join(self.cacheDir, name)
+      try:
+        st = os.stat(path)
+      except EnvironmentError:
+        continue
+      entries.append( (path, st.st_size, st.st_mtime) )
+    return entries
+
+  def _evict(self):
+    """Remove least recently used binaries until cache fits in maxBytes"""
+    entries = self._list_entries()
+    totalBytes = sum([e[1] for e in entries])
+    for path, size, mtime in sorted(entries, key=lambda e: e[2]):
+      if totalBytes <= self.maxBytes:
+        break
+      self._remove_file(path)
+      totalBytes -= size
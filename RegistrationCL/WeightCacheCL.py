@@ -0,0 +1,86 @@
+#
+# WeightCacheCL: LRU cache of Gaussian weight volumes on a CL device
+#
+# Weight volumes of poly-affine components depend only on the volume shape,
+# spacing, and origin, and on the center and radii of the component, all of
+# which form the cache key. An entry therefore never goes stale: volumes of
+# components that moved or were removed are simply no longer requested and
+# age out. The cache keeps the most recently used volumes up to a budget in
+# bytes.
+#
+# Cached images are shared, callers must not modify them.
+#
+# Author: Marcel Prastawa (marcel.prastawa@gmail.com)
+#
+
+import collections
+
+class WeightCacheCL:
+
+  def __init__(self, maxBytes=256*1024*1024):
+
+    # Cached ImageCL objects, least recently used first
+    self.entries = collections.OrderedDict()
+
+    self.maxBytes = maxBytes
+    self.numBytes = 0
+
+    # Statistics
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @staticmethod
+  def get_key(shape, center, radii, spacing, origin):
+    """Returns cache key of a weight volume"""
+    return (tuple([int(x) for x in shape]),
+      tuple([float(x) for x in center]),
+      tuple([float(x) for x in radii]),
+      tuple([float(x) for x in spacing]),
+      tuple([float(x) for x in origin]))
+
+  def get(self, key, builder):
+    """Returns cached weight volume, calling builder() on a miss"""
+
+    if self.entries.has_key(key):
+      self.hits += 1
+      imgcl = self.entries.pop(key)
+      self.entries[key] = imgcl
+      return imgcl
+
+    self.misses += 1
+
+    imgcl = builder()
+
+    nbytes = imgcl.clarray.nbytes
+    if nbytes <= self.maxBytes:
+      self.entries[key] = imgcl
+      self.numBytes += nbytes
+      self._evict()
+
+    return imgcl
+
+  def clear(self):
+    """Drop all entries"""
+    self.entries.clear()
+    self.numBytes = 0
+
+  def stats(self):
+    """Returns dictionary of cache statistics"""
+    return {
+      "hits" : self.hits,
+      "misses" : self.misses,
+      "evictions" : self.evictions,
+      "entries" : len(self.entries),
+      "bytes" : self.numBytes,
+      }
+
+  def _remove(self, key):
+    imgcl = self.entries.pop(key)
+    self.numBytes -= imgcl.clarray.nbytes
+
+  def _evict(self):
+    while self.numBytes > self.maxBytes and len(self.entries) > 0:
+      key = self.entries.keys()[0]
+      self._remove(key)
+      self.evictions += 1
@@ -1,10 +1,19 @@
 
+from DeviceCL import DeviceCL
+from ProgramCache import ProgramCache
+from MemoryPoolCL import MemoryPoolCL
 from ImageCL import ImageCL
+from ImageExpressionCL import ImageExpressionCL
 
 # Steering based on fluid flow
 from DeformationCL import DeformationCL
 
 # Steering using poly-affine
+from AnchorIndex import AnchorIndex
+from WeightCacheCL import WeightCacheCL
 from PolyAffineCL import PolyAffineCL
+from PolyAffineOptimizer import PolyAffineOptimizer
+from PolyAffineLBFGS import PolyAffineLBFGS
+from PolyAffineGaussNewton import PolyAffineGaussNewton
 from SteeringRotation import SteeringRotation
 from SteeringScale import SteeringScale
@@ -13,7 +13,7 @@ import numpy as n
 import pyopencl as cl
 import pyopencl.array as cla
 
-from RegistrationCL import ImageCL, DeformationCL
+from RegistrationCL import DeviceCL, ImageCL, DeformationCL
 
 # TODO add support for downsampling and upsampling in ImageCL and DeformationCL?
 
@@ -658,6 +658,17 @@ class SteeredFluidRegistrationLogic(object):
     self.lastHoveredGradMag = 0
 
     self.preferredDeviceType = "GPU"
+
+    # Recycle per-iteration CL buffers through a memory pool
+    self.useMemoryPool = False
+
+    # Store deformations as displacements, so that the identity is a zero
+    # field and velocities are used directly as small deformations
+    self.useDisplacementFields = False
+
+    # Device storage of images and deformations, "half" halves memory use
+    # and turns on useDisplacementFields when registration starts, see ImageCL
+    self.imageStorage = "float"
     
   def __del__(self):
   
@@ -697,15 +708,26 @@ class SteeredFluidRegistrationLogic(object):
 
     return axialVolume
 
+  def setupDevice(self):
+    """Set up the memory pool before any image buffer is allocated, so that
+    input images also come from the pool"""
+    cldevice = DeviceCL.get(self.preferredDeviceType)
+    if self.useMemoryPool:
+      cldevice.enable_memory_pool()
+    else:
+      cldevice.disable_memory_pool()
+
   def useFixedVolume(self, volume):
 
+    self.setupDevice()
+
     # TODO store original orientation?
     axialVolume = self.reorientVolumeToAxial(volume)
     self.axialFixedVolume = axialVolume
 
     widget = slicer.modules.SteeredFluidRegistrationWidget
 
-    self.fixedImageCL = ImageCL(self.preferredDeviceType)
+    self.fixedImageCL = ImageCL(self.preferredDeviceType, self.imageStorage)
     self.fixedImageCL.fromVolume(axialVolume)
     self.fixedImageCL.normalize()
 
@@ -725,11 +747,13 @@ class SteeredFluidRegistrationLogic(object):
 
   def useMovingVolume(self, volume):
 
+    self.setupDevice()
+
     # TODO store original orientation?
     axialVolume = self.reorientVolumeToAxial(volume)
     self.axialMovingVolume = axialVolume
 
-    self.movingImageCL = ImageCL(self.preferredDeviceType)
+    self.movingImageCL = ImageCL(self.preferredDeviceType, self.imageStorage)
     self.movingImageCL.fromVolume(axialVolume)
     self.movingImageCL.normalize()
 
@@ -738,6 +762,8 @@ class SteeredFluidRegistrationLogic(object):
     # TODO: need to store old deformation for this to work, for now reset everything
     widget = slicer.modules.SteeredFluidRegistrationWidget
 
+    self.setupDevice()
+
     if outputVolume is None:
       vl = slicer.modules.volumes.logic()
       # Use reoriented moving volume
@@ -749,7 +775,7 @@ class SteeredFluidRegistrationLogic(object):
       outputVolume.SetAndObserveImageData(outputImage)
       #TODO reuse deformation
 
-    self.outputImageCL = ImageCL(self.preferredDeviceType)
+    self.outputImageCL = ImageCL(self.preferredDeviceType, self.imageStorage)
     self.outputImageCL.fromVolume(outputVolume)
     self.outputImageCL.normalize()
         
@@ -884,16 +910,23 @@ class SteeredFluidRegistrationLogic(object):
     applicationLogic = slicer.app.applicationLogic()
     applicationLogic.FitSliceToAll()
     
+    # Absolute positions lose too much precision in half storage
+    if self.imageStorage == "half" and not self.useDisplacementFields:
+      print("Half image storage requires displacement fields, enabling them")
+      self.useDisplacementFields = True
+
     self.outputImageCL_down = self.outputImageCL.resample(
       self.fixedImageCL_down.shape)
 
-    self.identityCL_down = DeformationCL(self.fixedImageCL_down)
+    self.identityCL_down = DeformationCL.get_identity(self.fixedImageCL_down,
+      displacement=self.useDisplacementFields)
     self.deformationCL_down = self.identityCL_down
 
 # TODO:
 # resample output volume to display grid using CPU
 # set identityCL and deformationCL to be this size
-    self.identityCL = DeformationCL(self.outputImageCL)
+    self.identityCL = DeformationCL.get_identity(self.outputImageCL,
+      displacement=self.useDisplacementFields)
     self.deformationCL = self.identityCL
     
     self.fluidDelta = 0.0
@@ -908,6 +941,8 @@ class SteeredFluidRegistrationLogic(object):
     self.actionState = "idle"
     self.removeObservers()
 
+    self.fixedImageCL.cldevice.trim_memory_pool()
+
   def updateStep(self):
   
     self.registrationIterationNumber = self.registrationIterationNumber + 1
@@ -1115,11 +1150,10 @@ class SteeredFluidRegistrationLogic(object):
       velocitiesCL_down[dim] = \
         momentasCL_down[dim].recursive_gaussian(self.fluidKernelWidth)
       
-    # Compute max velocity
-    velocMagCL = velocitiesCL_down[0].multiply(velocitiesCL_down[0])
+    # Compute max velocity, fused into a single reduction
+    velocMagCL = velocitiesCL_down[0].lazy().square()
     for dim in xrange(1,3):
-      velocMagCL.add_inplace(
-        velocitiesCL_down[dim].multiply(velocitiesCL_down[dim]) )
+      velocMagCL = velocMagCL.add( velocitiesCL_down[dim].lazy().square() )
       
     maxVeloc = velocMagCL.max()
 
@@ -1143,8 +1177,12 @@ class SteeredFluidRegistrationLogic(object):
     if isArrowUsed:
       self.fluidDelta = 0.0
 
-    smallDeformationCL_down = self.identityCL_down.clone()
-    smallDeformationCL_down.add_velocity(velocitiesCL_down)
+    if self.useDisplacementFields:
+      smallDeformationCL_down = DeformationCL(self.fixedImageCL_down,
+        velocitiesCL_down, displacement=True)
+    else:
+      smallDeformationCL_down = self.identityCL_down.clone()
+      smallDeformationCL_down.add_velocity(velocitiesCL_down)
 
     self.deformationCL_down = self.deformationCL_down.compose(
       smallDeformationCL_down)
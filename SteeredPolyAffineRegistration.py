@@ -515,6 +515,13 @@ class SteeredPolyAffineRegistrationLogic(object):
     # parameter defaults
     self.numberAffines = 1
     self.drawIterations = 1
+
+    # Fraction of voxels sampled at each poly-affine iteration, values below
+    # one keep steering responsive on large volumes
+    self.sampleFraction = 1.0
+
+    # Merge anchors added by corrections beyond this count, None to disable
+    self.maxAnchors = None
     self.polyAffineRadius = 10.0
 
     # TODO
@@ -527,6 +534,11 @@ class SteeredPolyAffineRegistrationLogic(object):
 
     self.steerMode = "rotate"
 
+    self.polyAffine = None
+
+    # Anchor under the mouse cursor in erase mode
+    self.highlightedAnchor = None
+
     self.position = []
     self.paintCoordinates = []
 
@@ -761,6 +773,8 @@ class SteeredPolyAffineRegistrationLogic(object):
     # Initialize poly affine
     self.polyAffine = PolyAffineCL(self.fixedImageCL, self.movingImageCL)
     self.polyAffine.create_identity(self.numberAffines)
+    self.polyAffine.sampleFraction = self.sampleFraction
+    self.polyAffine.mergeMaxAnchors = self.maxAnchors
     # TODO: use radius info from GUI
     self.polyAffine.optimize_setup()
 
@@ -787,7 +801,7 @@ class SteeredPolyAffineRegistrationLogic(object):
 
     # Only upsample and redraw updated image every N iterations
     if self.registrationIterationNumber % self.drawIterations == 0:
-      self.outputImageCL = self.polyAffine.movingCL
+      self.outputImageCL = self.polyAffine.get_moving()
 
       self.updateOutputVolume(self.outputImageCL)
       self.redrawSlices()
@@ -814,11 +828,6 @@ class SteeredPolyAffineRegistrationLogic(object):
     origin = movingVolume.GetOrigin()
     """
 
-    spacing = self.fixedImageCL.spacing
-
-    movingRAStoIJK = vtk.vtkMatrix4x4()
-    self.axialMovingVolume.GetRASToIJKMatrix(movingRAStoIJK)
-
     actionItem = self.actionQueue.get()
 
     #TODO: draw green circle representing current input on images?
@@ -826,18 +835,8 @@ class SteeredPolyAffineRegistrationLogic(object):
     startRAS = actionItem[5]
     endRAS = actionItem[6]
 
-    startIJK = movingRAStoIJK.MultiplyPoint(startRAS + (1,))
-    endIJK = movingRAStoIJK.MultiplyPoint(endRAS + (1,))
-
-    x = np.zeros((3,), np.float32)
-    y = np.zeros((3,), np.float32)
-
-    maxd = 2.0
-    for d in range(3):
-      x[d] = startIJK[d] * spacing[d]
-      y[d] = endIJK[d] * spacing[d]
-
-      maxd = max(maxd, 1.05*abs(x[d]-y[d]))
+    x = self.rasToAnchorSpace(startRAS)
+    y = self.rasToAnchorSpace(endRAS)
 
     #r = np.ones((3,), np.float32) * maxd
     r = np.ones((3,), np.float32) * max(2.0, 1.05 * np.linalg.norm(x - y))
@@ -846,7 +845,10 @@ class SteeredPolyAffineRegistrationLogic(object):
 
     if steerMode == "erase":
       # TODO: list of added affines, user can select to undo specific ones
-      self.polyAffine.remove_affine(x, r[0])
+      # Erase the anchor highlighted under the cursor, if any
+      i = self.findAnchorAt(x)
+      if i is not None:
+        self.polyAffine.remove_affine(x, np.min(self.polyAffine.radii[i]))
       self.polyAffine.optimize_setup()
       return
 
@@ -861,13 +863,49 @@ class SteeredPolyAffineRegistrationLogic(object):
     A, T = steerer.steer()
 
     # Append user defined affine to polyaffine
-    self.polyAffine.add_affine(A, T, x, r)
+    mergeReports = self.polyAffine.add_affine(A, T, x, r)
 
     print "Added A", A, "T", T
 
+    for report in mergeReports:
+      print "Merged affine components at", report["centers"][0], "and", \
+        report["centers"][1], "overlap", report["overlap"], \
+        "RMS error", report["rmsError"], "max error", report["maxError"]
+
     # TODO: reinitialize optimizer? Fix user affine?
     self.polyAffine.optimize_setup()
 
+  def rasToAnchorSpace(self, ras):
+    """Convert RAS position to the coordinates of poly-affine anchors"""
+    spacing = self.fixedImageCL.spacing
+
+    movingRAStoIJK = vtk.vtkMatrix4x4()
+    self.axialMovingVolume.GetRASToIJKMatrix(movingRAStoIJK)
+
+    ijk = movingRAStoIJK.MultiplyPoint(tuple(ras) + (1,))
+
+    x = np.zeros((3,), np.float32)
+    for d in range(3):
+      x[d] = ijk[d] * spacing[d]
+
+    return x
+
+  def findAnchorUnderCursor(self, ras):
+    """Returns index of the anchor whose radius contains ras, or None"""
+    if self.polyAffine is None:
+      return None
+
+    return self.findAnchorAt(self.rasToAnchorSpace(ras))
+
+  def findAnchorAt(self, x):
+    """Returns index of the nearest anchor if its radius contains x, in
+    anchor space, or None. Used by both erase highlighting and erasing."""
+    i, dist = self.polyAffine.nearest_anchor(x)
+    if i is None or dist > np.min(self.polyAffine.radii[i]):
+      return None
+
+    return i
+
   def processEvent(self,observee,event=None):
 
     eventProcessed = False
@@ -989,7 +1027,18 @@ class SteeredPolyAffineRegistrationLogic(object):
           """
           
           if nodeIndex > 2:
-            cursor = qt.QCursor(qt.Qt.OpenHandCursor)
+            # Highlight anchor that would be erased
+            self.highlightedAnchor = None
+            if self.steerMode == "erase":
+              xy = style.GetInteractor().GetEventPosition()
+              xyz = sliceWidget.sliceView().convertDeviceToXYZ(xy)
+              ras = sliceWidget.sliceView().convertXYZToRAS(xyz)
+              self.highlightedAnchor = self.findAnchorUnderCursor(ras)
+
+            if self.highlightedAnchor is not None:
+              cursor = qt.QCursor(qt.Qt.PointingHandCursor)
+            else:
+              cursor = qt.QCursor(qt.Qt.OpenHandCursor)
             app.setOverrideCursor(cursor)
           else:
             cursor = qt.QCursor(qt.Qt.ForbiddenCursor)
@@ -0,0 +1,112 @@
+
+#
+# Benchmark the fluid update loop of SteeredFluidRegistration with planar
+# (three ImageCL) and interleaved (float4) DeformationCL storage, each
+# storing absolute coordinates or displacements, e.g.
+#
+#   python benchmarkDeformationLayout.py blob_big.mha blob_small.mha
+#
+# Each iteration computes image forces, adds a splatted user force, smooths
+# momenta into velocities, and composes the deformation, as in updateStep.
+# Reports time per iteration for each storage and the largest difference
+# between its warped image and the one from planar absolute storage.
+#
+
+import SimpleITK as sitk
+
+import math, os, sys, time
+
+import numpy as np
+
+if len(sys.argv) < 3:
+  print "Usage", sys.argv[0], " fixed moving [iterations] [kernelWidth]"
+  sys.exit(-1)
+
+numIterations = 20
+if len(sys.argv) > 3:
+  numIterations = int(sys.argv[3])
+
+fluidKernelWidth = 15.0
+if len(sys.argv) > 4:
+  fluidKernelWidth = float(sys.argv[4])
+
+sys.path.append("..")
+from RegistrationCL import *
+
+# Which CL device?
+#preferredDeviceType = "CPU"
+preferredDeviceType = "GPU"
+
+fixedImage = sitk.ReadImage(sys.argv[1])
+movingImage = sitk.ReadImage(sys.argv[2])
+
+fixedArray = sitk.GetArrayFromImage(fixedImage).astype('float32')
+movingArray = sitk.GetArrayFromImage(movingImage).astype('float32')
+
+fixedCL = ImageCL(preferredDeviceType)
+fixedCL.fromArray(fixedArray, [0,0,0], fixedImage.GetSpacing())
+fixedCL.normalize()
+
+movingCL = ImageCL(preferredDeviceType)
+movingCL.fromArray(movingArray, [0,0,0], fixedImage.GetSpacing())
+movingCL.normalize()
+
+# Synthetic user force at the image center
+center = [0.5 * fixedCL.shape[d] * fixedCL.spacing[d] for d in range(3)]
+forceX = np.array([center], np.float32)
+forceV = np.array([[1.0, 0.5, 0.0]], np.float32)
+sigmaM = np.array([(0.1 * min(fixedCL.shape) * min(fixedCL.spacing))**2],
+  np.float32)
+
+def run(interleaved, displacement):
+  identityCL = DeformationCL.get_identity(fixedCL, interleaved, displacement)
+  deformationCL = identityCL
+  outputCL = movingCL.clone()
+
+  fixedCL.clqueue.finish()
+
+  t0 = time.time()
+  for iter in range(numIterations):
+    diffCL = fixedCL.subtract(outputCL)
+
+    gradientsCL = DeformationCL.gradient_field(outputCL, interleaved)
+    momentasCL = gradientsCL.multiply(diffCL).recursive_gaussian(
+      fluidKernelWidth)
+    momentasCL.add_splat(forceX, forceV, sigmaM)
+
+    velocitiesCL = momentasCL.recursive_gaussian(fluidKernelWidth)
+
+    maxVeloc = velocitiesCL.maxMagnitude()
+    if maxVeloc <= 0.0:
+      break
+    velocitiesCL.scale(2.0 / maxVeloc)
+
+    if displacement:
+      smallDeformationCL = velocitiesCL
+      smallDeformationCL.displacement = True
+    else:
+      smallDeformationCL = identityCL.clone()
+      smallDeformationCL.add_velocity(velocitiesCL)
+
+    deformationCL = deformationCL.compose(smallDeformationCL)
+
+    outputCL = deformationCL.applyTo(movingCL)
+
+  fixedCL.clqueue.finish()
+
+  return (time.time() - t0) / numIterations, outputCL.clarray.get()
+
+print "Volume size", fixedCL.shape
+
+refTime = None
+refOutput = None
+for interleaved in [False, True]:
+  for displacement in [False, True]:
+    runTime, output = run(interleaved, displacement)
+    if refTime is None:
+      refTime = runTime
+      refOutput = output
+    name = "%s %s" % (["Planar", "Interleaved"][interleaved],
+      ["absolute", "displacement"][displacement])
+    print "%s time per iteration %.4f s, speedup %.2f, max difference %g" % \
+      (name, runTime, refTime / runTime, np.abs(output - refOutput).max())
@@ -0,0 +1,131 @@
+
+#
+# Compare float and half image storage on the fluid update loop of
+# SteeredFluidRegistration, e.g.
+#
+#   python benchmarkHalfStorage.py blob_big.mha blob_small.mha
+#
+# Both runs use displacement fields. Reports device memory held by the
+# images and deformation fields, time per iteration, the effective bandwidth
+# of warping the moving image, and the difference between the half and
+# float results, including adding an ROI back into an image with addROI.
+#
+
+import SimpleITK as sitk
+
+import os, sys, time
+
+import numpy as np
+
+if len(sys.argv) < 3:
+  print "Usage", sys.argv[0], " fixed moving [iterations] [kernelWidth]"
+  sys.exit(-1)
+
+numIterations = 20
+if len(sys.argv) > 3:
+  numIterations = int(sys.argv[3])
+
+fluidKernelWidth = 15.0
+if len(sys.argv) > 4:
+  fluidKernelWidth = float(sys.argv[4])
+
+sys.path.append("..")
+from RegistrationCL import *
+
+# Which CL device?
+#preferredDeviceType = "CPU"
+preferredDeviceType = "GPU"
+
+fixedImage = sitk.ReadImage(sys.argv[1])
+movingImage = sitk.ReadImage(sys.argv[2])
+
+fixedArray = sitk.GetArrayFromImage(fixedImage).astype('float32')
+movingArray = sitk.GetArrayFromImage(movingImage).astype('float32')
+
+def run(storage):
+  fixedCL = ImageCL(preferredDeviceType, storage)
+  fixedCL.fromArray(fixedArray, [0,0,0], fixedImage.GetSpacing())
+  fixedCL.normalize()
+
+  movingCL = ImageCL(preferredDeviceType, storage)
+  movingCL.fromArray(movingArray, [0,0,0], fixedImage.GetSpacing())
+  movingCL.normalize()
+
+  identityCL = DeformationCL.get_identity(fixedCL, displacement=True)
+  deformationCL = identityCL
+  outputCL = movingCL.clone()
+
+  fixedCL.clqueue.finish()
+
+  t0 = time.time()
+  for iter in range(numIterations):
+    diffCL = fixedCL.subtract(outputCL)
+
+    gradientsCL = DeformationCL.gradient_field(outputCL)
+    momentasCL = gradientsCL.multiply(diffCL).recursive_gaussian(
+      fluidKernelWidth)
+    velocitiesCL = momentasCL.recursive_gaussian(fluidKernelWidth)
+
+    maxVeloc = velocitiesCL.maxMagnitude()
+    if maxVeloc <= 0.0:
+      break
+    velocitiesCL.scale(2.0 / maxVeloc)
+    velocitiesCL.displacement = True
+
+    deformationCL = deformationCL.compose(velocitiesCL)
+
+    outputCL = deformationCL.applyTo(movingCL)
+
+  fixedCL.clqueue.finish()
+  iterTime = (time.time() - t0) / numIterations
+
+  # Warp alone, reads the map and up to 8 voxels and writes one voxel
+  numWarps = 10
+  t0 = time.time()
+  for iter in range(numWarps):
+    deformationCL.applyTo(movingCL)
+  fixedCL.clqueue.finish()
+  warpTime = (time.time() - t0) / numWarps
+
+  itemsize = np.dtype(fixedCL.storage_dtype()).itemsize
+  numVoxels = np.prod(fixedCL.shape)
+  warpBytes = numVoxels * itemsize * (3 + 8 + 1)
+
+  # Fixed, moving, output, and two deformation fields held between
+  # iterations of SteeredFluidRegistration
+  stateBytes = numVoxels * itemsize * (3 + 2*3)
+
+  u = np.array([deformationCL.hx.clarray.get(), deformationCL.hy.clarray.get(),
+    deformationCL.hz.clarray.get()], np.float32)
+
+  # Adding an ROI back into its image doubles the ROI voxels
+  center = [fixedCL.origin[d] + 0.5*fixedCL.shape[d]*fixedCL.spacing[d]
+    for d in range(3)]
+  radius = [0.25*fixedCL.shape[d]*fixedCL.spacing[d] for d in range(3)]
+  roiSumCL = fixedCL.clone()
+  roiSumCL.addROI(fixedCL.getROI(center, radius))
+
+  return iterTime, warpTime, warpBytes, stateBytes, \
+    outputCL.clarray.get().astype(np.float32), u, \
+    roiSumCL.clarray.get().astype(np.float32)
+
+print "Volume size", fixedArray.shape
+
+results = {}
+for storage in ["float", "half"]:
+  iterTime, warpTime, warpBytes, stateBytes, output, u, roiSum = run(storage)
+  results[storage] = (output, u, roiSum)
+  print "%s storage:" % storage
+  print "  time per iteration %.4f s" % iterTime
+  print "  warp time %.4f s, effective bandwidth %.2f GB/s" % \
+    (warpTime, warpBytes / warpTime / 1e9)
+  print "  persistent image and field memory %.1f MB" % (stateBytes / 1e6)
+
+outputDiff = np.abs(results["half"][0] - results["float"][0])
+uDiff = np.abs(results["half"][1] - results["float"][1])
+print "Output intensity difference max %g mean %g" % \
+  (outputDiff.max(), outputDiff.mean())
+print "Displacement difference max %g mean %g (physical units)" % \
+  (uDiff.max(), uDiff.mean())
+roiDiff = np.abs(results["half"][2] - results["float"][2])
+print "addROI difference max %g mean %g" % (roiDiff.max(), roiDiff.mean())
@@ -0,0 +1,97 @@
+
+#
+# Benchmark poly-affine optimizers, reporting wall clock time and number of
+# iterations needed to reach a target error, e.g.
+#
+#   python benchmarkPolyAffineOptimizers.py blob_big.mha blob_small.mha
+#
+# The target error is targetRatio times the initial SSD. Each optimizer
+# starts from the identity transform.
+#
+
+import SimpleITK as sitk
+
+import os, sys, time
+
+if len(sys.argv) < 3:
+  print "Usage", sys.argv[0], " fixed moving [targetRatio] [maxIters]"
+  sys.exit(-1)
+
+targetRatio = 0.5
+if len(sys.argv) > 3:
+  targetRatio = float(sys.argv[3])
+
+maxIters = 50
+if len(sys.argv) > 4:
+  maxIters = int(sys.argv[4])
+
+sys.path.append("..")
+from RegistrationCL import *
+
+# Which CL device?
+#preferredDeviceType = "CPU"
+preferredDeviceType = "GPU"
+
+fixedImage = sitk.ReadImage(sys.argv[1])
+movingImage = sitk.ReadImage(sys.argv[2])
+
+fixedArray = sitk.GetArrayFromImage(fixedImage).astype('float32')
+movingArray = sitk.GetArrayFromImage(movingImage).astype('float32')
+
+fixedCL = ImageCL(preferredDeviceType)
+fixedCL.fromArray(fixedArray, fixedImage.GetOrigin(), fixedImage.GetSpacing())
+
+movingCL = ImageCL(preferredDeviceType)
+movingCL.fromArray(movingArray, fixedImage.GetOrigin(), fixedImage.GetSpacing())
+
+def run(name, optimizer, batchedLineSearch=True):
+  polyAffine = PolyAffineCL(fixedCL, movingCL)
+  polyAffine.create_identity(3)
+  polyAffine.optimizer = optimizer
+  polyAffine.batchedLineSearch = batchedLineSearch
+  polyAffine.optimize_setup()
+
+  fixedCL.clqueue.finish()
+
+  target = targetRatio * polyAffine.refErrorL2
+
+  t0 = time.time()
+  numIters = 0
+  while numIters < maxIters and polyAffine.currErrorL2 > target:
+    polyAffine.optimize_step()
+    numIters += 1
+  fixedCL.clqueue.finish()
+  elapsed = time.time() - t0
+
+  return (name, numIters, elapsed, polyAffine.currErrorL2 / polyAffine.refErrorL2)
+
+# First run compiles the CL programs
+run("warmup", None)
+
+results = []
+results.append(run("Gradient descent", None, False))
+results.append(run("Gradient descent, batched line search", None))
+results.append(run("L-BFGS", PolyAffineLBFGS()))
+results.append(run("Gauss-Newton", PolyAffineGaussNewton()))
+
+# Coarse to fine schedule, pyramid construction included in the time
+polyAffine = PolyAffineCL(fixedCL, movingCL)
+polyAffine.create_identity(3)
+polyAffine.optimize_setup()
+refErrorL2 = polyAffine.refErrorL2
+
+t0 = time.time()
+polyAffine.optimize_pyramid()
+fixedCL.clqueue.finish()
+pyramidTime = time.time() - t0
+
+pyramidError = fixedCL.lazy().subtract(polyAffine.get_moving()).square().sum()
+
+print
+print "Target SSD ratio", targetRatio
+for name, numIters, elapsed, ratio in results:
+  print "%-40s iters %3d  time %8.3f s  SSD ratio %.4f" % (
+    name, numIters, elapsed, ratio)
+print "%-40s iters %3d  time %8.3f s  SSD ratio %.4f" % (
+  "Pyramid " + str(polyAffine.pyramidShrinkFactors),
+  sum(polyAffine.pyramidIterations), pyramidTime, pyramidError / refErrorL2)
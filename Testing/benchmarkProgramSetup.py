@@ -0,0 +1,75 @@
+
+#
+# Benchmark CL program builds and first iteration latency of the poly-affine
+# optimizer, e.g.
+#
+#   python benchmarkProgramSetup.py blob_big.mha blob_small.mha
+#
+# Reports the number of programs built from source against the number of
+# distinct image shapes seen by ImageCL.setup, which is the number of builds
+# needed when the program was specialized for each image shape.
+#
+
+import SimpleITK as sitk
+
+import os, sys, time
+
+if len(sys.argv) < 3:
+  print "Usage", sys.argv[0], " fixed moving [iterations]"
+  sys.exit(-1)
+
+numIterations = 3
+if len(sys.argv) > 3:
+  numIterations = int(sys.argv[3])
+
+sys.path.append("..")
+from RegistrationCL import *
+
+# Which CL device?
+#preferredDeviceType = "CPU"
+preferredDeviceType = "GPU"
+
+# Record shapes of all images set up on the CL device
+setupShapes = set()
+origSetup = ImageCL.setup
+def countingSetup(self):
+  setupShapes.add(tuple(self.shape))
+  origSetup(self)
+ImageCL.setup = countingSetup
+
+fixedImage = sitk.ReadImage(sys.argv[1])
+movingImage = sitk.ReadImage(sys.argv[2])
+
+fixedArray = sitk.GetArrayFromImage(fixedImage).astype('float32')
+movingArray = sitk.GetArrayFromImage(movingImage).astype('float32')
+
+t0 = time.time()
+
+fixedCL = ImageCL(preferredDeviceType)
+fixedCL.fromArray(fixedArray, fixedImage.GetOrigin(), fixedImage.GetSpacing())
+
+movingCL = ImageCL(preferredDeviceType)
+movingCL.fromArray(movingArray, fixedImage.GetOrigin(), fixedImage.GetSpacing())
+
+polyAffine = PolyAffineCL(fixedCL, movingCL)
+polyAffine.create_identity(3)
+polyAffine.optimize_setup()
+
+t1 = time.time()
+
+iterTimes = []
+for iter in range(numIterations):
+  tstart = time.time()
+  polyAffine.optimize_step()
+  iterTimes.append(time.time() - tstart)
+
+print "Setup time %.3f s" % (t1 - t0)
+for iter in range(numIterations):
+  print "Iteration %d time %.3f s" % (iter, iterTimes[iter])
+print "Distinct image shapes", len(setupShapes)
+print "CL programs built", DeviceCL.programBuilds
+
+programCache = DeviceCL.programCache
+if programCache is not None:
+  print "Program binaries loaded from cache", programCache.binaryLoads
+  print "Programs built from source", programCache.sourceBuilds
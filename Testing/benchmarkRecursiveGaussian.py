@@ -0,0 +1,56 @@
+
+#
+# Benchmark ImageCL.recursive_gaussian with lines staged in local memory
+# against one work item per line reading global memory, e.g.
+#
+#   python benchmarkRecursiveGaussian.py 64 128 256
+#
+# Volumes are cubes of random values with the given widths. Reports time per
+# filter for both paths and the largest difference between their results.
+#
+
+import os, sys, time
+
+import numpy as np
+
+sizes = [64, 128, 256]
+if len(sys.argv) > 1:
+  sizes = [int(a) for a in sys.argv[1:]]
+
+sigma = 15.0
+numRepeats = 10
+
+sys.path.append("..")
+from RegistrationCL import *
+
+# Which CL device?
+#preferredDeviceType = "CPU"
+preferredDeviceType = "GPU"
+
+def run(imgcl, tiled):
+  ImageCL.useTiledGaussian = tiled
+
+  # First call builds kernels
+  outimgcl = imgcl.recursive_gaussian(sigma)
+  imgcl.clqueue.finish()
+
+  t0 = time.time()
+  for i in range(numRepeats):
+    outimgcl = imgcl.recursive_gaussian(sigma)
+  imgcl.clqueue.finish()
+
+  return (time.time() - t0) / numRepeats, outimgcl.clarray.get()
+
+for n in sizes:
+  imgcl = ImageCL(preferredDeviceType)
+  imgcl.fromArray(np.random.rand(n, n, n).astype(np.float32), [0,0,0],
+    [1,1,1])
+
+  globalTime, globalOutput = run(imgcl, False)
+  tiledTime, tiledOutput = run(imgcl, True)
+
+  print "%d^3: global %.4f s, tiled %.4f s, speedup %.2f, max difference %g" % \
+    (n, globalTime, tiledTime, globalTime / tiledTime,
+    np.abs(globalOutput - tiledOutput).max())
+
+ImageCL.useTiledGaussian = True
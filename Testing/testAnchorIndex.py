@@ -0,0 +1,148 @@
+
+#
+# Compare AnchorIndex queries against brute force search over a list of
+# anchors changed by random inserts, removes, and moves. Runs on the host,
+# no CL device needed, e.g.
+#
+#   python testAnchorIndex.py [iterations] [seed]
+#
+
+import numpy
+
+import os, sys
+
+numIterations = 500
+if len(sys.argv) > 1:
+  numIterations = int(sys.argv[1])
+
+seed = 0
+if len(sys.argv) > 2:
+  seed = int(sys.argv[2])
+
+# Import directly, the RegistrationCL package requires PyOpenCL
+sys.path.append(os.path.join("..", "RegistrationCL"))
+from AnchorIndex import AnchorIndex
+
+rng = numpy.random.RandomState(seed)
+
+def random_point():
+  # Clustered points test crowded cells, scattered points test far rings
+  if rng.rand() < 0.5:
+    return rng.normal(0.0, 3.0, (3,))
+  return rng.uniform(-50.0, 50.0, (3,))
+
+def brute_force(points, p, maxDist):
+  found = []
+  for i in range(len(points)):
+    d = numpy.linalg.norm(points[i] - p)
+    if d <= maxDist:
+      found.append((i, d))
+  found.sort(key=lambda c: c[1])
+  return found
+
+def check_result(points, p, result, expected, name):
+  # Indices may differ between anchors at equal distance, distances may not
+  if len(result) != len(expected):
+    print "FAIL", name, "found", len(result), "expected", len(expected)
+    return False
+  for (i, d), (j, e) in zip(result, expected):
+    if abs(d - e) > 1e-9:
+      print "FAIL", name, "distance", d, "expected", e
+      return False
+    if abs(numpy.linalg.norm(points[i] - p) - d) > 1e-9:
+      print "FAIL", name, "wrong distance reported for anchor", i
+      return False
+  if len(set([i for i, d in result])) != len(result):
+    print "FAIL", name, "duplicate anchors"
+    return False
+  return True
+
+def check_cells(index, points):
+  # Every anchor is in exactly one cell, the one holding its position
+  members = []
+  for key in index.cells:
+    if len(index.cells[key]) == 0:
+      print "FAIL empty cell kept", key
+      return False
+    for i in index._get_indices(index.cells[key]):
+      if index._get_cell(points[i]) != key:
+        print "FAIL anchor", i, "in wrong cell"
+        return False
+      members.append(i)
+  if sorted(members) != range(len(points)):
+    print "FAIL cells hold", sorted(members), "for", len(points), "anchors"
+    return False
+  # Occupied cell bounds contain every anchor
+  for key in index.cells:
+    for d in range(3):
+      if not index.cellMin[d] <= key[d] <= index.cellMax[d]:
+        print "FAIL cell", key, "outside bounds"
+        return False
+  return True
+
+cellSize = rng.uniform(0.5, 5.0)
+points = [random_point() for i in range(20)]
+
+index = AnchorIndex()
+index.rebuild(points, cellSize)
+
+numFailures = 0
+
+for iter in range(numIterations):
+  op = rng.randint(4)
+  if op == 0 or len(points) < 2:
+    p = random_point()
+    points.append(p)
+    if index.insert(p) != len(points)-1:
+      print "FAIL insert returned wrong index"
+      numFailures += 1
+  elif op == 1:
+    i = rng.randint(len(points))
+    del points[i]
+    index.remove(i)
+  elif op == 2:
+    i = rng.randint(len(points))
+    # Small moves mostly stay in the same cell
+    if rng.rand() < 0.5:
+      points[i] = points[i] + rng.normal(0.0, 0.1*cellSize, (3,))
+    else:
+      points[i] = random_point()
+    index.move(i, points[i])
+  else:
+    # Duplicate an existing position to test ties
+    p = points[rng.randint(len(points))].copy()
+    points.append(p)
+    index.insert(p)
+
+  if not check_cells(index, points):
+    numFailures += 1
+    break
+
+  for q in range(3):
+    p = random_point()
+
+    k = rng.randint(1, 8)
+    maxDist = float('Inf')
+    if rng.rand() < 0.5:
+      maxDist = rng.uniform(0.0, 30.0)
+    expected = brute_force(points, p, maxDist)
+    if not check_result(points, p, index.knn(p, k, maxDist), expected[:k],
+        "knn"):
+      numFailures += 1
+
+    dist = rng.uniform(0.0, 30.0)
+    expected = brute_force(points, p, dist)
+    if not check_result(points, p, index.radius(p, dist), expected,
+        "radius"):
+      numFailures += 1
+
+    expected = brute_force(points, p, float('Inf'))
+    i, d = index.nearest(p)
+    if not check_result(points, p, [(i, d)], expected[:1], "nearest"):
+      numFailures += 1
+
+print "Anchors", len(points), "cell size", cellSize
+print "Iterations", numIterations, "failures", numFailures
+
+if numFailures > 0:
+  sys.exit(-1)
@@ -38,7 +38,7 @@ polyAffine = PolyAffineCL(fixedCL, movingCL)
 polyAffine.create_identity(4)
 polyAffine.optimize(40)
 
-warpedCL = polyAffine.movingCL
+warpedCL = polyAffine.get_moving()
 warpedArray = warpedCL.clarray.get().astype('float32')
 
 print "Writing warped image"
@@ -0,0 +1,224 @@
+
+#
+# Host checks of the poly-affine optimizers: parameter vector packing, the
+# gradient in parameter units, the L-BFGS two-loop recursion, and L-BFGS
+# iterations on a quadratic error. No CL device needed, e.g.
+#
+#   python testPolyAffineOptimizers.py [seed]
+#
+
+import numpy
+
+import os, sys
+
+seed = 0
+if len(sys.argv) > 1:
+  seed = int(sys.argv[1])
+
+# Import directly, the RegistrationCL package requires PyOpenCL
+sys.path.append(os.path.join("..", "RegistrationCL"))
+from PolyAffineOptimizer import PolyAffineOptimizer
+from PolyAffineLBFGS import PolyAffineLBFGS
+
+rng = numpy.random.RandomState(seed)
+
+numFailures = 0
+
+def check(ok, name):
+  global numFailures
+  if ok:
+    print "ok  ", name
+  else:
+    print "FAIL", name
+    numFailures += 1
+
+def random_spd(n, condition):
+  Q, R = numpy.linalg.qr(rng.normal(size=(n, n)))
+  return numpy.dot(Q * numpy.linspace(1.0, condition, n), Q.T)
+
+class QuadraticPolyAffine:
+  """Stands in for PolyAffineCL, with error 0.5 (p-p0)' H (p-p0) over the
+  unscaled affine and translation entries p of all components"""
+
+  def __init__(self, numTransforms):
+    n = 12*numTransforms
+    self.H = random_spd(n, 10.0)
+    self.p0 = rng.normal(size=(n,))
+
+    self.affines = []
+    self.translations = []
+    self.centers = []
+    self.radii = []
+    for q in range(numTransforms):
+      self.affines.append(numpy.eye(3, dtype=numpy.single))
+      self.translations.append(numpy.zeros((3,), numpy.single))
+      self.centers.append(rng.uniform(0.0, 50.0, (3,)).astype(numpy.single))
+      self.radii.append(rng.uniform(5.0, 15.0, (3,)).astype(numpy.single))
+
+    self.optimIter = 0
+    self.normalizeWeights = False
+    self.currErrorL2 = self.error(self.affines, self.translations)
+
+  def pack(self, AList, TList):
+    p = numpy.zeros((len(AList), 12), numpy.float64)
+    for q in range(len(AList)):
+      p[q,0:9] = AList[q].ravel()
+      p[q,9:12] = TList[q]
+    return p.ravel()
+
+  def error(self, AList, TList):
+    r = self.pack(AList, TList) - self.p0
+    return 0.5 * numpy.dot(r, numpy.dot(self.H, r))
+
+  def gradient_terms(self):
+    r = self.pack(self.affines, self.translations) - self.p0
+    g = numpy.dot(self.H, r).reshape(-1, 12)
+    # Anchor terms are not used by the optimizers
+    return [numpy.concatenate((g[q], numpy.zeros(3))) for q in range(len(g))]
+
+  def line_search_steps(self, steps, dAList=None, dTList=None, dCList=None):
+    # Same acceptance rule as PolyAffineCL.line_search_steps
+    n = len(self.affines)
+    trials = []
+    for s in steps[:8]:
+      AList = [self.affines[q] - dAList[q]*s for q in range(n)]
+      TList = [self.translations[q] - dTList[q]*s for q in range(n)]
+      trials.append((self.error(AList, TList), s, AList, TList))
+    best = min(trials, key=lambda t: t[0])
+    if best[0] >= self.currErrorL2:
+      return None
+    self.currErrorL2, s, self.affines, self.translations = best
+    return s
+
+#
+# Parameter vector packing
+#
+
+polyAffine = QuadraticPolyAffine(3)
+for q in range(3):
+  polyAffine.affines[q] = rng.normal(size=(3,3)).astype(numpy.single)
+  polyAffine.translations[q] = rng.normal(size=(3,)).astype(numpy.single)
+
+optimizer = PolyAffineOptimizer()
+optimizer.setup(polyAffine)
+
+L = optimizer.lengthScale
+check(abs(L - numpy.mean(polyAffine.radii)) < 1e-5,
+  "length scale is mean radius")
+
+x = optimizer.get_parameters(polyAffine)
+ok = x.shape == (36,)
+for q in range(3):
+  ok = ok and numpy.allclose(x[12*q:12*q+9],
+    polyAffine.affines[q].ravel() * L)
+  ok = ok and numpy.allclose(x[12*q+9:12*q+12], polyAffine.translations[q])
+check(ok, "get_parameters layout")
+
+affines = [A.copy() for A in polyAffine.affines]
+translations = [T.copy() for T in polyAffine.translations]
+optimizer.set_parameters(polyAffine, rng.normal(size=x.shape))
+optimizer.set_parameters(polyAffine, x)
+ok = True
+for q in range(3):
+  ok = ok and numpy.allclose(polyAffine.affines[q], affines[q], atol=1e-6)
+  ok = ok and numpy.allclose(polyAffine.translations[q], translations[q])
+  ok = ok and polyAffine.affines[q].shape == (3,3)
+  ok = ok and polyAffine.affines[q].dtype == numpy.single
+check(ok, "set_parameters inverts get_parameters")
+
+#
+# Gradient with respect to the scaled parameter vector, by central
+# differences of the error
+#
+
+g = optimizer.get_gradient(polyAffine)
+x = optimizer.get_parameters(polyAffine)
+h = 1e-2
+gNumeric = numpy.zeros(x.shape)
+for i in range(len(x)):
+  e = numpy.zeros(x.shape)
+  e[i] = h
+  optimizer.set_parameters(polyAffine, x + e)
+  fPlus = polyAffine.error(polyAffine.affines, polyAffine.translations)
+  optimizer.set_parameters(polyAffine, x - e)
+  fMinus = polyAffine.error(polyAffine.affines, polyAffine.translations)
+  gNumeric[i] = (fPlus - fMinus) / (2.0*h)
+optimizer.set_parameters(polyAffine, x)
+check(numpy.allclose(g, gNumeric, rtol=1e-3, atol=1e-3),
+  "get_gradient matches finite differences")
+
+#
+# Base class keeps parameters fixed
+#
+
+optimizer.anchorInterval = 0
+optimizer.step(polyAffine)
+check(numpy.allclose(optimizer.get_parameters(polyAffine), x),
+  "base class update keeps parameters")
+
+#
+# Two-loop recursion against the dense inverse Hessian update
+#
+
+n = 20
+H = random_spd(n, 50.0)
+lbfgs = PolyAffineLBFGS(memory=6)
+for i in range(6):
+  s = rng.normal(size=(n,))
+  lbfgs.sList.append(s)
+  lbfgs.yList.append(numpy.dot(H, s))
+
+s = lbfgs.sList[-1]
+y = lbfgs.yList[-1]
+Hinv = numpy.eye(n) * numpy.dot(s, y) / numpy.dot(y, y)
+for s, y in zip(lbfgs.sList, lbfgs.yList):
+  rho = 1.0 / numpy.dot(y, s)
+  V = numpy.eye(n) - rho * numpy.outer(y, s)
+  Hinv = numpy.dot(V.T, numpy.dot(Hinv, V)) + rho * numpy.outer(s, s)
+
+g = rng.normal(size=(n,))
+check(numpy.allclose(lbfgs._apply_inverse_hessian(g), numpy.dot(Hinv, g)),
+  "two-loop recursion equals dense BFGS update")
+
+check(numpy.allclose(lbfgs._apply_inverse_hessian(lbfgs.yList[-1]),
+  lbfgs.sList[-1]), "two-loop recursion satisfies secant condition")
+
+# With n H-conjugate pairs the estimate is the exact inverse
+evals, evecs = numpy.linalg.eigh(H)
+lbfgs = PolyAffineLBFGS(memory=n)
+for i in range(n):
+  lbfgs.sList.append(evecs[:,i])
+  lbfgs.yList.append(numpy.dot(H, evecs[:,i]))
+check(numpy.allclose(lbfgs._apply_inverse_hessian(g),
+  numpy.linalg.solve(H, g)), "two-loop recursion exact for conjugate pairs")
+
+lbfgs = PolyAffineLBFGS()
+check(numpy.allclose(lbfgs._apply_inverse_hessian(g), g),
+  "two-loop recursion is identity without history")
+
+#
+# L-BFGS iterations on the quadratic
+#
+
+polyAffine = QuadraticPolyAffine(2)
+lbfgs = PolyAffineLBFGS(memory=5)
+lbfgs.anchorInterval = 0
+lbfgs.setup(polyAffine)
+
+errors = [polyAffine.currErrorL2]
+maxHistory = 0
+for iter in range(150):
+  polyAffine.optimIter = iter + 1
+  lbfgs.step(polyAffine)
+  errors.append(polyAffine.currErrorL2)
+  maxHistory = max(maxHistory, len(lbfgs.sList))
+
+check(numpy.all(numpy.diff(errors) <= 0.0), "L-BFGS error never increases")
+check(maxHistory == lbfgs.memory, "L-BFGS history bounded by memory")
+check(errors[-1] < 1e-6 * errors[0], "L-BFGS converges on quadratic")
+print "  error", errors[0], "->", errors[-1]
+
+print "Failures", numFailures
+
+if numFailures > 0:
+  sys.exit(-1)